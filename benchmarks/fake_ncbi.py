@@ -0,0 +1,150 @@
+"""
+Deterministic local stand-in for the NCBI "datasets" command, for
+benchmarks and tests. Called as
+
+    python fake_ncbi.py datasets summary gene symbol G1 G2 --taxon human --as-json-lines
+
+Genes are named "G<k>" (NCBI GeneID 100000 + k), every 10th gene is not
+found. Each call sleeps FAKE_NCBI_LATENCY seconds plus
+FAKE_NCBI_GENE_LATENCY seconds per gene (environment variables).
+
+Failures of "datasets" are injected by environment variables:
+    FAKE_NCBI_FAIL        "429", "503", "exit" (non-zero exit without a
+                          message), "truncate" (a cut json line, then
+                          "connection reset" and exit 1) or "garbage"
+                          (a non-json line and exit 0).
+    FAKE_NCBI_FAIL_CALLS  Only the first N calls fail, counted in the file
+                          FAKE_NCBI_STATE, defaults to every call.
+    FAKE_NCBI_FAIL_GENES  Comma separated genes, a call with one of them
+                          fails with a permanent "invalid identifier" error.
+"""
+import os
+import sys
+import json
+from pathlib import Path
+from time import sleep
+
+__author__ = "Johnathan Lin <jagonball@g-mail.nsysu.edu.tw>"
+__email__ = "jagonball@g-mail.nsysu.edu.tw"
+
+GENE_ID_OFFSET = 100000
+N_GO_TERMS = 2000
+
+
+def gene_number(identifier, input_type):
+    """The number k of gene "G<k>", None if not a known gene."""
+    try:
+        if input_type == "gene-id":
+            k = int(identifier) - GENE_ID_OFFSET
+        else:
+            k = int(identifier.upper().lstrip("G"))
+    except ValueError:
+        return None
+    if k < 0 or k % 10 == 0:
+        return None
+    return k
+
+
+def go_terms(k, n, offset):
+    """Deterministic GO terms of gene k."""
+    return [{"go_id": f"GO:{(k * 7 + offset + j * 13) % N_GO_TERMS:07d}",
+             "name": f"term {(k * 7 + offset + j * 13) % N_GO_TERMS}"}
+            for j in range(n)]
+
+
+def gene_report(k):
+    """The "datasets" gene report of gene k."""
+    return {"gene_id": str(GENE_ID_OFFSET + k),
+            "symbol": f"G{k}",
+            "description": f"synthetic gene {k}",
+            "type": "PROTEIN_CODING",
+            "orientation": "plus" if k % 2 else "minus",
+            "synonyms": [f"S{k}A", f"S{k}B"][:k % 3],
+            "transcript_count": k % 7 + 1,
+            "protein_count": k % 5 + 1,
+            "nomenclature_authority": {"identifier": f"HGNC:{k}"},
+            "gene_ontology": {
+                "biological_processes": go_terms(k, k % 4 + 1, 0),
+                "cellular_components": go_terms(k, 1, 500),
+                "molecular_functions": go_terms(k, k % 3, 1000)}}
+
+
+def inject_failure(genes):
+    """Fail the call as set by the FAKE_NCBI_FAIL variables, if it should."""
+    fail_genes = os.environ.get("FAKE_NCBI_FAIL_GENES", "")
+    for gene in genes:
+        if gene in fail_genes.split(","):
+            sys.stderr.write(f"Error: invalid identifier {gene}\n")
+            sys.exit(1)
+    mode = os.environ.get("FAKE_NCBI_FAIL")
+    if not mode:
+        return
+    if "FAKE_NCBI_FAIL_CALLS" in os.environ:
+        state_file = Path(os.environ["FAKE_NCBI_STATE"])
+        calls = int(state_file.read_text()) if state_file.exists() else 0
+        state_file.write_text(str(calls + 1))
+        if calls >= int(os.environ["FAKE_NCBI_FAIL_CALLS"]):
+            return
+    if mode == "429":
+        sys.stderr.write("Error: 429 Too Many Requests\n")
+        sys.exit(1)
+    elif mode == "503":
+        sys.stderr.write("Error: 503 Service Unavailable\n")
+        sys.exit(1)
+    elif mode == "exit":
+        sys.exit(2)
+    elif mode == "truncate":
+        print(json.dumps({"gene": gene_report(1), "query": [genes[0]]})[:40])
+        sys.stdout.flush()
+        sys.stderr.write("Error: connection reset by peer\n")
+        sys.exit(1)
+    elif mode == "garbage":
+        print("<html>Bad gateway</html>")
+        sys.exit(0)
+
+
+def datasets(args):
+    """datasets summary gene <input_type> <genes...> --taxon <taxon> --as-json-lines"""
+    input_type = args[2]
+    stop = args.index("--taxon") if "--taxon" in args else len(args)
+    genes = args[3:stop]
+    sleep(float(os.environ.get("FAKE_NCBI_LATENCY", 0))
+          + float(os.environ.get("FAKE_NCBI_GENE_LATENCY", 0)) * len(genes))
+    inject_failure(genes)
+    for gene in genes:
+        k = gene_number(gene, input_type)
+        if k is None:
+            report = {"warnings": [{"gene_warning_code": "NOT_FOUND"}],
+                      "query": [gene]}
+        else:
+            report = {"gene": gene_report(k), "query": [gene]}
+        print(json.dumps(report))
+
+
+def write_wrappers(folder):
+    """Write a "datasets" wrapper calling this script.
+
+    :param folder: Folder of the wrapper.
+    :type folder: Path
+    :return: Path to the "datasets" wrapper.
+    :rtype: Path
+    """
+    fake = Path(__file__).resolve()
+    if sys.platform == "win32":
+        wrapper = folder / "datasets.bat"
+        wrapper.write_text(f'@"{sys.executable}" "{fake}" datasets %*\n')
+    else:
+        wrapper = folder / "datasets"
+        wrapper.write_text(f'#!/bin/sh\nexec "{sys.executable}" '
+                           f'"{fake}" datasets "$@"\n')
+        wrapper.chmod(0o755)
+    return wrapper
+
+
+if __name__=="__main__":
+    command, args = sys.argv[1], sys.argv[2:]
+    if command == "datasets":
+        datasets(args)
+    else:
+        sys.stderr.write(f"Error: unknown command {command}\n")
+        sys.exit(1)
@@ -0,0 +1,233 @@
+"""
+Time "read_df", "df_cat_filter", "data_migrate" conversion and the
+"ncbi_data" annotation path on synthetic tables, with "fake_ncbi.py" in
+place of the NCBI tools. Results are written as JSON to "results/" and
+compared with the previous (or a chosen) result file.
+"""
+import os
+import sys
+import json
+import shutil
+import platform
+from pathlib import Path
+from time import perf_counter, strftime
+import numpy as np
+import pandas as pd
+
+BENCH_FOLDER = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_FOLDER.parent / "scripts"))
+from utilities import read_df, df_cat_filter, text_color, Profiler, pa
+from data_migrate import convert_sheet
+from annotation_cache import AnnotationCache
+from ncbi_client import DatasetsClient
+from ncbi_data import lookup_genes_cached, annotate_table
+from side_outputs import SideOutputStore
+from synthetic_data import write_inputs
+from fake_ncbi import write_wrappers
+
+__author__ = "Johnathan Lin <jagonball@g-mail.nsysu.edu.tw>"
+__email__ = "jagonball@g-mail.nsysu.edu.tw"
+
+FIELDS = "symbol,gene-id,synonyms,description,gene-type,\
+go-bp-id,go-bp-name,go-cc-id,go-cc-name,go-mf-id,go-mf-name,\
+orientation,transcript-count,protein-count"
+DICT_COL = {"NCBI GeneID": "Gene_ID",
+            "Synonyms": "Synonyms",
+            "Description": "Description",
+            "Gene Type": "Gene_Type",
+            "Orientation": "Orientation",
+            "Transcripts": "Transcripts",
+            "Proteins": "Proteins"}
+DICT_GO = {"Gene Ontology Biological Process Go ID": "GOBP_ID",
+           "Gene Ontology Biological Process Name": "GOBP_NAME",
+           "Gene Ontology Cellular Component Go ID": "GOCC_ID",
+           "Gene Ontology Cellular Component Name": "GOCC_NAME",
+           "Gene Ontology Molecular Function Go ID": "GOMF_ID",
+           "Gene Ontology Molecular Function Name": "GOMF_NAME"}
+
+
+def time_runs(function, repeats, setup=None):
+    """Time "function" over "repeats" runs, "setup" runs untimed before each.
+
+    :return: Seconds of each run.
+    :rtype: list
+    """
+    seconds = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = perf_counter()
+        function()
+        seconds.append(perf_counter() - start)
+    return seconds
+
+
+def summarize(benchmark, n_rows, seconds, **extra):
+    """One result row: best and median seconds and rows per second."""
+    best = min(seconds)
+    return {"benchmark": benchmark,
+            "rows": n_rows,
+            "repeats": len(seconds),
+            "best_s": round(best, 4),
+            "median_s": round(float(np.median(seconds)), 4),
+            "rows_per_s": round(n_rows / best, 1) if best > 0 else None,
+            **extra}
+
+
+def run_ncbi(df, work_folder, datasets_path, batch_size, workers):
+    """Annotate "df" with an empty cache, as one "ncbi_data.py" run.
+
+    :return: The profiler report of the run.
+    :rtype: dict
+    """
+    run_folder = work_folder / "ncbi_run"
+    shutil.rmtree(run_folder, ignore_errors=True)
+    run_folder.mkdir(parents=True)
+    profiler = Profiler()
+    ## No rate limit, the fake backend has its own latency.
+    client = DatasetsClient(datasets_path, max_rps=1e6, backoff=0.01,
+                            profiler=profiler)
+    cache = AnnotationCache(run_folder / "cache.sqlite")
+    def lookup(genes):
+        return lookup_genes_cached(genes, "symbol", "human", FIELDS, cache,
+                                   batch_size=batch_size, workers=workers,
+                                   client=client)
+    side_store = SideOutputStore(run_folder / "side_outputs.sqlite")
+    df_annot, _ = annotate_table(df, "symbol", "symbol", lookup, "all",
+                                 DICT_COL, DICT_GO, side_store, profiler)
+    with profiler.stage("write"):
+        df_annot.to_csv(run_folder / "annotate.txt", sep='\t', index=False)
+    side_store.close()
+    cache.close()
+    return profiler.report()
+
+
+def compare(df_current, report, baseline_file):
+    """Print the best time of each benchmark against a previous result file,
+    a ratio above 1 is slower than the baseline. Result files of another
+    config (other than "sizes", matched by rows) are not compared.
+
+    :param df_current: The current results.
+    :type df_current: DataFrame
+    :param report: The current report, with "config" and "environment".
+    :type report: dict
+    :param baseline_file: Path to the result file to compare with.
+    :type baseline_file: Path
+    """
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    for section in ["config", "environment"]:
+        current, base = report[section], baseline.get(section, {})
+        differ = [key for key in dict.fromkeys(list(current) + list(base))
+                  if key != "sizes" and current.get(key) != base.get(key)]
+        for key in differ:
+            print(f"{text_color('Warning', 'bright_yellow')}: {key} is "
+                  f"{current.get(key)}, {base.get(key)} in {baseline_file.name}")
+        if section == "config" and differ:
+            print(f"Not compared with {text_color(baseline_file.name, 'cyan')}, "
+                  f"set \"baseline_file\" to a result of the same config.")
+            return
+    df_base = pd.DataFrame(baseline["results"])
+    df = df_current.merge(df_base[["benchmark", "rows", "best_s"]],
+                          on=["benchmark", "rows"], how="left",
+                          suffixes=("", "_baseline"))
+    df["ratio"] = (df["best_s"] / df["best_s_baseline"]).round(3)
+    print(f"Compared with {text_color(baseline_file.name, 'cyan')}:")
+    for row in df.itertuples():
+        if pd.isna(row.ratio):
+            color, mark = None, "new"
+        else:
+            color = "red" if row.ratio > 1.1 else \
+                "green" if row.ratio < 0.9 else None
+            mark = f"x{row.ratio}"
+        print(f"  {row.benchmark:<16} {row.rows:>7} rows: {row.best_s:>9.4f} s "
+              f"{text_color(mark, color)}")
+
+
+def main():
+    ## Table sizes (probes), repeats of each benchmark and of the
+    ## "ncbi_data" path, and the largest table also timed as Excel.
+    sizes = [1000, 20000, 100000]
+    repeats = 5
+    ncbi_repeats = 1
+    excel_max_rows = 20000
+    seed = 0
+    ## Fake backend: seconds per "datasets" call and per gene, genes per
+    ## call and concurrent calls.
+    latency = 0.05
+    gene_latency = 0.0005
+    batch_size = 100
+    workers = 4
+    ## Result file to compare with, None for the latest earlier result.
+    ## Only results of the same config are compared.
+    baseline_file = None
+
+    work_folder = BENCH_FOLDER / "work"
+    results_folder = BENCH_FOLDER / "results"
+    work_folder.mkdir(exist_ok=True)
+    results_folder.mkdir(exist_ok=True)
+    os.environ["FAKE_NCBI_LATENCY"] = str(latency)
+    os.environ["FAKE_NCBI_GENE_LATENCY"] = str(gene_latency)
+    datasets_path = write_wrappers(work_folder)
+    inputs = write_inputs(work_folder / "data", sizes, excel_max_rows, seed)
+
+    results = []
+    for n_rows, (text_file, excel_file) in inputs.items():
+        print(f"Table of {text_color(n_rows, 'cyan')} rows...")
+        seconds = time_runs(lambda: read_df(text_file), repeats)
+        results.append(summarize("read_df", n_rows, seconds))
+
+        if pa is not None:  # The cache needs "pyarrow".
+            cache_dir = work_folder / "read_cache"
+            read_df(text_file, cache_dir=cache_dir)
+            seconds = time_runs(lambda: read_df(text_file, cache_dir=cache_dir),
+                                repeats)
+            results.append(summarize("read_df_cached", n_rows, seconds))
+
+        df = read_df(text_file)
+        seconds = time_runs(lambda: df_cat_filter(df, "regulation", "up"),
+                            repeats)
+        results.append(summarize("df_cat_filter", n_rows, seconds))
+
+        if excel_file is not None:
+            output_file = work_folder / f"{excel_file.stem}_migrate.txt"
+            seconds = time_runs(lambda: convert_sheet(excel_file, 0,
+                                                      output_file), repeats)
+            results.append(summarize("data_migrate", n_rows, seconds))
+
+        reports = []
+        seconds = time_runs(lambda: reports.append(
+            run_ncbi(df, work_folder, datasets_path, batch_size, workers)),
+            ncbi_repeats)
+        results.append(summarize("ncbi_data", n_rows, seconds,
+                                 genes=reports[-1]["counters"].get("genes"),
+                                 stages=reports[-1]["stages"],
+                                 latency=reports[-1]["latency"]))
+
+    df_results = pd.DataFrame(results)
+    print(df_results[["benchmark", "rows", "best_s", "median_s",
+                      "rows_per_s"]].to_string(index=False))
+    previous = sorted(results_folder.glob("bench_*.json"))
+    output_file = results_folder / f"bench_{strftime('%Y%m%d_%H%M%S')}.json"
+    report = {"environment": {"python": platform.python_version(),
+                              "platform": platform.platform(),
+                              "cpu_count": os.cpu_count(),
+                              "numpy": np.__version__,
+                              "pandas": pd.__version__},
+              "config": {"sizes": sizes, "repeats": repeats,
+                         "ncbi_repeats": ncbi_repeats, "seed": seed,
+                         "latency": latency, "gene_latency": gene_latency,
+                         "batch_size": batch_size, "workers": workers},
+              "results": results}
+    with open(output_file, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results: {text_color(output_file, 'green')}")
+
+    if baseline_file is None and previous:
+        baseline_file = previous[-1]
+    if baseline_file is not None:
+        compare(df_results, report, Path(baseline_file))
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Synthetic probe x sample microarray tables for benchmarks.
+"""
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+__author__ = "Johnathan Lin <jagonball@g-mail.nsysu.edu.tw>"
+__email__ = "jagonball@g-mail.nsysu.edu.tw"
+
+
+def synthetic_matrix(n_rows, n_samples=6, duplicate_rate=0.4, missing_rate=0.02,
+                     seed=0):
+    """A probe table in the layout of "Microarray_Huh7_normalized.txt".
+
+    :param n_rows: Number of probes.
+    :type n_rows: int
+    :param n_samples: Number of log2 expression columns, defaults to 6
+    :type n_samples: int, optional
+    :param duplicate_rate: Share of probes whose symbol is also on another
+        probe, defaults to 0.4 (about 1.7 probes per gene)
+    :type duplicate_rate: float, optional
+    :param missing_rate: Share of probes without a symbol, defaults to 0.02
+    :type missing_rate: float, optional
+    :param seed: Random seed, defaults to 0
+    :type seed: int, optional
+    :return: Columns "ProbeName", "symbol", "regulation" and the samples.
+        Symbols are "G<k>", known to "fake_ncbi.py".
+    :rtype: DataFrame
+    """
+    rng = np.random.default_rng(seed)
+    n_genes = max(1, int(n_rows * (1 - duplicate_rate)))
+    ## Every gene once, the rest drawn again from the genes.
+    genes = np.concatenate([np.arange(1, n_genes + 1),
+                            rng.integers(1, n_genes + 1, n_rows - n_genes)])
+    rng.shuffle(genes)
+    symbols = pd.Series([f"G{k}" for k in genes], dtype=object)
+    symbols[rng.random(n_rows) < missing_rate] = None
+
+    df = pd.DataFrame({"ProbeName": [f"A_{23 + k % 3}_P{k:06d}"
+                                     for k in range(n_rows)],
+                       "symbol": symbols})
+    base = rng.normal(8, 2, n_rows)
+    for j in range(n_samples):
+        df[f"Sample_{j + 1}"] = np.round(base + rng.normal(0, 0.5, n_rows), 4)
+    log_fc = df.iloc[:, -1] - df.iloc[:, 2]
+    df["regulation"] = np.select([log_fc > 0.5, log_fc < -0.5],
+                                 ["up", "down"], "ns")
+    return df
+
+
+def write_inputs(folder, sizes, excel_max_rows=20000, seed=0):
+    """Write the synthetic tables of each size, as tab-separated text and,
+    up to "excel_max_rows", as Excel workbooks.
+
+    :param folder: Output folder.
+    :type folder: Path
+    :param sizes: Numbers of probes.
+    :type sizes: list
+    :param excel_max_rows: Largest table also written as Excel, defaults
+        to 20000
+    :type excel_max_rows: int, optional
+    :param seed: Random seed, defaults to 0
+    :type seed: int, optional
+    :return: The text file and the workbook (None if not written) of each size.
+    :rtype: dict
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    inputs = {}
+    for n_rows in sizes:
+        text_file = folder / f"synthetic_{n_rows}_seed{seed}.txt"
+        excel_file = folder / f"synthetic_{n_rows}_seed{seed}.xlsx"
+        if not text_file.exists():
+            df = synthetic_matrix(n_rows, seed=seed)
+            df.to_csv(text_file, sep='\t', index=False)
+            if n_rows <= excel_max_rows:
+                df.to_excel(excel_file, index=False)
+        inputs[n_rows] = (text_file,
+                          excel_file if excel_file.exists() else None)
+    return inputs
@@ -0,0 +1,227 @@
+"""
+On-disk cache of NCBI gene annotation results.
+"""
+import io
+import sqlite3
+from pathlib import Path
+from time import time
+import numpy as np
+import pandas as pd
+
+__author__ = "Johnathan Lin <jagonball@g-mail.nsysu.edu.tw>"
+__email__ = "jagonball@g-mail.nsysu.edu.tw"
+
+
+class AnnotationCache:
+    """SQLite store of "datasets" results for each queried identifier.
+
+    An entry is keyed by input type, identifier, taxon and field set, and
+    holds the result table of that identifier as tsv text (an empty text
+    for no matching gene). Entries older than "ttl" are ignored and
+    removed, the least recently used entries are evicted when the stored
+    results exceed "max_bytes".
+
+    :param db_path: Path to the SQLite file, created if not exist.
+    :type db_path: str or Path
+    :param ttl: Time to live of an entry in seconds, defaults to None (forever)
+    :type ttl: float, optional
+    :param max_bytes: Maximum size of stored results, defaults to None (no limit)
+    :type max_bytes: int, optional
+    """
+    ## Max number of "?" in one query, below the SQLite limit.
+    chunk_size = 500
+
+    def __init__(self, db_path, ttl=None, max_bytes=None):
+        self.db_path = Path(db_path)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS gene_cache (
+                                 input_type TEXT,
+                                 identifier TEXT,
+                                 taxon TEXT,
+                                 fields TEXT,
+                                 result TEXT,
+                                 size INTEGER,
+                                 created REAL,
+                                 accessed REAL,
+                                 PRIMARY KEY (input_type, identifier,
+                                              taxon, fields))""")
+        self.conn.execute("""CREATE INDEX IF NOT EXISTS idx_accessed
+                             ON gene_cache (accessed)""")
+        self.conn.commit()
+
+    @staticmethod
+    def normalize_fields(fields):
+        """Normalize a comma separated field list to a stable key.
+
+        :param fields: The "--fields" value, ex: "symbol, gene-id".
+        :type fields: str
+        :return: The stripped fields joined by ",".
+        :rtype: str
+        """
+        return ",".join(field.strip() for field in fields.split(",")
+                        if field.strip())
+
+    def get(self, input_type, taxon, fields, identifiers):
+        """Get the cached results of identifiers.
+
+        :param input_type: "symbol", "gene-id", "accession" or "taxon".
+        :type input_type: str
+        :param taxon: The "--taxon" value.
+        :type taxon: str
+        :param fields: The "--fields" value.
+        :type fields: str
+        :param identifiers: Identifiers to look up.
+        :type identifiers: list
+        :return: Result DataFrame of each cached identifier.
+        :rtype: dict
+        """
+        fields = self.normalize_fields(fields)
+        identifiers = list(dict.fromkeys(identifiers))
+        oldest = time() - self.ttl if self.ttl else 0
+        gene_results = {}
+        for start in range(0, len(identifiers), self.chunk_size):
+            chunk = identifiers[start:start + self.chunk_size]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.conn.execute(
+                f"""SELECT identifier, result FROM gene_cache
+                    WHERE input_type = ? AND taxon = ? AND fields = ?
+                    AND created >= ? AND identifier IN ({placeholders})""",
+                [input_type, taxon, fields, oldest] + chunk).fetchall()
+            gene_results.update(self.parse_results(rows))
+            self.conn.executemany(
+                """UPDATE gene_cache SET accessed = ?
+                   WHERE input_type = ? AND identifier = ?
+                   AND taxon = ? AND fields = ?""",
+                [(time(), input_type, identifier, taxon, fields)
+                 for identifier, _ in rows])
+        self.conn.commit()
+        self.hits += len(gene_results)
+        self.misses += len(identifiers) - len(gene_results)
+        return gene_results
+
+    @staticmethod
+    def parse_results(rows):
+        """Parse the results with the same header in one "read_csv" call.
+
+        :param rows: Identifier and result text of each entry.
+        :type rows: list
+        :return: Result DataFrame of each identifier.
+        :rtype: dict
+        """
+        gene_results = {}
+        groups = {}
+        for identifier, result in rows:
+            header, _, body = result.partition("\n")
+            if result == "":
+                gene_results[identifier] = pd.DataFrame()
+            elif '"' in body:  # Quoted values may span lines.
+                gene_results[identifier] = pd.read_csv(io.StringIO(result),
+                                                       sep="\t")
+            else:
+                groups.setdefault(header, []).append((identifier, body))
+        for header, group in groups.items():
+            identifiers, bodies = zip(*group)
+            n_rows = [body.count("\n") for body in bodies]
+            bounds = np.r_[0, np.cumsum(n_rows)]
+            df = pd.read_csv(io.StringIO(header + "\n" + "".join(bodies)),
+                             sep="\t")
+            ## Row positions within each result, so the slices need no reset.
+            df.index = np.arange(len(df)) - np.repeat(bounds[:-1], n_rows)
+            for i, identifier in enumerate(identifiers):
+                gene_results[identifier] = df.iloc[bounds[i]:bounds[i + 1]]
+        return gene_results
+
+    @staticmethod
+    def format_results(gene_results):
+        """Format the results with the same columns in one "to_csv" call,
+        then cut the lines by identifier.
+
+        :param gene_results: Result DataFrame of each identifier.
+        :type gene_results: dict
+        :return: Result text of each identifier, "" for an empty result.
+        :rtype: dict
+        """
+        results = {}
+        groups = {}
+        for identifier, df_gene in gene_results.items():
+            if df_gene.empty:
+                results[identifier] = ""
+            else:
+                key = (tuple(df_gene.columns), tuple(map(str, df_gene.dtypes)))
+                groups.setdefault(key, []).append(identifier)
+        for identifiers in groups.values():
+            list_df = [gene_results[identifier] for identifier in identifiers]
+            df_group = pd.concat(list_df, ignore_index=True)
+            codes = np.repeat(np.arange(len(list_df)),
+                              [len(df) for df in list_df])
+            ## Values with line breaks span lines, format their genes alone.
+            breaks = np.zeros(len(df_group), dtype=bool)
+            for col in df_group.columns:
+                if not pd.api.types.is_numeric_dtype(df_group[col]):
+                    breaks |= df_group[col].str.contains("\n", regex=False,
+                                                         na=False).to_numpy(bool)
+            alone = np.isin(codes, codes[breaks])
+            for i in np.unique(codes[alone]):
+                results[identifiers[i]] = list_df[i].to_csv(
+                    sep="\t", index=False, lineterminator="\n")
+            df_group, codes = df_group[~alone], codes[~alone]
+            header = df_group.iloc[0:0].to_csv(sep="\t", index=False,
+                                               lineterminator="\n")
+            lines = df_group.to_csv(sep="\t", index=False, header=False,
+                                    lineterminator="\n").split("\n")
+            bounds = np.r_[0, np.cumsum(np.bincount(codes,
+                                                    minlength=len(list_df)))]
+            for i in np.unique(codes):
+                results[identifiers[i]] = header + "\n".join(
+                    lines[bounds[i]:bounds[i + 1]]) + "\n"
+        return results
+
+    def put(self, input_type, taxon, fields, gene_results):
+        """Store results, then evict expired and oversized entries.
+
+        :param input_type: "symbol", "gene-id", "accession" or "taxon".
+        :type input_type: str
+        :param taxon: The "--taxon" value.
+        :type taxon: str
+        :param fields: The "--fields" value.
+        :type fields: str
+        :param gene_results: Result DataFrame of each identifier.
+        :type gene_results: dict
+        """
+        fields = self.normalize_fields(fields)
+        now = time()
+        rows = [(input_type, identifier, taxon, fields,
+                 result, len(result), now, now)
+                for identifier, result in self.format_results(gene_results).items()]
+        self.conn.executemany("""INSERT OR REPLACE INTO gene_cache
+                                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+        self.conn.commit()
+        self.evict()
+
+    def evict(self):
+        """Remove expired entries and the least recently used entries
+        until the stored results fit in "max_bytes".
+        """
+        if self.ttl:
+            self.conn.execute("DELETE FROM gene_cache WHERE created < ?",
+                              (time() - self.ttl,))
+        if self.max_bytes:
+            total = self.conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM gene_cache").fetchone()[0]
+            if total > self.max_bytes:
+                ## Cumulative size from the most recently used entry.
+                self.conn.execute(
+                    """DELETE FROM gene_cache WHERE rowid IN (
+                           SELECT rowid FROM (
+                               SELECT rowid, SUM(size) OVER (
+                                   ORDER BY accessed DESC, rowid DESC
+                               ) AS kept FROM gene_cache)
+                           WHERE kept > ?)""", (self.max_bytes,))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,196 @@
+"""
+Gene x gene co-expression (Pearson or Spearman) computed in tiles, kept as
+a sparse edge list of the top-k partners of each gene or of the pairs
+above a threshold. Only a block of rows is in memory at a time.
+"""
+from pathlib import Path
+from time import time, ctime
+from concurrent.futures import ThreadPoolExecutor
+import sys
+import numpy as np
+import pandas as pd
+from scipy.stats import rankdata
+from utilities import read_df, show_time, text_color
+
+__author__ = "Johnathan Lin <jagonball@g-mail.nsysu.edu.tw>"
+__email__ = "jagonball@g-mail.nsysu.edu.tw"
+
+
+def standardize(matrix, method="pearson"):
+    """Center and scale each gene so that the dot product of two genes is
+    their correlation.
+
+    :param matrix: Gene x sample expression, without missing values.
+    :type matrix: ndarray
+    :param method: "pearson" or "spearman" (Pearson of the ranks),
+        defaults to "pearson"
+    :type method: str, optional
+    :return: The standardized matrix, genes without variance are all 0.
+    :rtype: ndarray of float32
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    if method == "spearman":
+        matrix = rankdata(matrix, axis=1)
+    matrix = matrix - matrix.mean(axis=1, keepdims=True)
+    norm = np.sqrt((matrix ** 2).sum(axis=1, keepdims=True))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        matrix = np.where(norm > 0, matrix / norm, 0)
+    return matrix.astype(np.float32)
+
+
+def block_edges(z, start, block_size, top_k=None, threshold=None):
+    """Correlate one block of genes with the other genes.
+
+    With "top_k", the block is compared to all genes and the k strongest
+    partners (by absolute correlation) of each gene are kept. Otherwise the
+    block is compared to the genes after it and the pairs with an absolute
+    correlation of at least "threshold" are kept, each pair once.
+
+    :param z: Standardized gene x sample matrix.
+    :type z: ndarray
+    :param start: First gene of the block.
+    :type start: int
+    :param block_size: Genes per block (and per column tile).
+    :type block_size: int
+    :param top_k: Partners kept per gene, defaults to None
+    :type top_k: int, optional
+    :param threshold: Minimum absolute correlation, defaults to None
+    :type threshold: float, optional
+    :return: Gene indexes of the edges and their correlation.
+    :rtype: tuple(ndarray, ndarray, ndarray)
+    """
+    n_genes = len(z)
+    stop = min(start + block_size, n_genes)
+    rows = np.arange(start, stop)
+    z_block = z[start:stop]
+    if top_k is not None:
+        best_index = np.empty((len(rows), 0), dtype=np.int64)
+        best_value = np.empty((len(rows), 0), dtype=np.float32)
+        for col_start in range(0, n_genes, block_size):
+            col_stop = min(col_start + block_size, n_genes)
+            tile = z_block @ z[col_start:col_stop].T
+            ## No self edges.
+            diag = rows[(rows >= col_start) & (rows < col_stop)]
+            tile[diag - start, diag - col_start] = np.nan
+            index = np.hstack([best_index,
+                               np.broadcast_to(np.arange(col_start, col_stop),
+                                               tile.shape)])
+            value = np.hstack([best_value, tile])
+            ## Keep the running top k, NaN last.
+            strength = np.nan_to_num(np.abs(value), nan=-1)
+            k = min(top_k, value.shape[1])
+            keep = np.argpartition(-strength, k - 1, axis=1)[:, :k]
+            best_index = np.take_along_axis(index, keep, axis=1)
+            best_value = np.take_along_axis(value, keep, axis=1)
+        order = np.argsort(-np.nan_to_num(np.abs(best_value), nan=-1),
+                           axis=1, kind="stable")
+        best_index = np.take_along_axis(best_index, order, axis=1)
+        best_value = np.take_along_axis(best_value, order, axis=1)
+        valid = ~np.isnan(best_value)
+        gene_a = np.broadcast_to(rows[:, None], best_index.shape)[valid]
+        return gene_a, best_index[valid], best_value[valid]
+
+    list_a, list_b, list_r = [], [], []
+    for col_start in range(start, n_genes, block_size):
+        col_stop = min(col_start + block_size, n_genes)
+        tile = z_block @ z[col_start:col_stop].T
+        hit_a, hit_b = np.nonzero(np.abs(tile) >= threshold)
+        hit_a += start
+        hit_b += col_start
+        upper = hit_a < hit_b
+        list_a.append(hit_a[upper])
+        list_b.append(hit_b[upper])
+        list_r.append(tile[hit_a[upper] - start, hit_b[upper] - col_start])
+    return np.concatenate(list_a), np.concatenate(list_b), np.concatenate(list_r)
+
+
+def coexpression_edges(z, block_size=2000, top_k=None, threshold=None,
+                       workers=1):
+    """Yield the edges block by block, in gene order. Blocks run in a
+    thread pool (the matrix products release the GIL), at most
+    2 x "workers" blocks are pending at a time.
+
+    :param z: Standardized gene x sample matrix from "standardize".
+    :type z: ndarray
+    :param block_size: Genes per block, defaults to 2000
+    :type block_size: int, optional
+    :param top_k: Partners kept per gene, defaults to None
+    :type top_k: int, optional
+    :param threshold: Minimum absolute correlation, used without "top_k",
+        defaults to None
+    :type threshold: float, optional
+    :param workers: Number of threads, defaults to 1
+    :type workers: int, optional
+    :return: Gene indexes of the edges and their correlation, per block.
+    :rtype: Iterator[tuple(ndarray, ndarray, ndarray)]
+    """
+    if top_k is None and threshold is None:
+        print(f"Set {text_color('top_k', 'red')} or "
+              f"{text_color('threshold', 'red')} to keep the edge list sparse.")
+        sys.exit()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for start in range(0, len(z), block_size):
+            pending.append(executor.submit(block_edges, z, start, block_size,
+                                           top_k, threshold))
+            if len(pending) >= 2 * workers:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+def main():
+    time_start = time()
+    print(f"coexpression.py start time: {ctime(time_start)}")
+
+    ## One row per gene, ex: the output of "probe_collapse.py".
+    input_file = Path("D:/Repositories/25_01_Liver_Cancer/data/Microarray_Huh7_normalized_collapsed.txt")
+    output_folder = Path("D:/Repositories/25_01_Liver_Cancer/analysis")
+    gene_col = "symbol"
+    # Expression columns, None for all the other numeric columns.
+    value_cols = None
+    # "pearson" or "spearman".
+    method = "pearson"
+    # Keep the "top_k" partners of each gene, or None for all the pairs
+    # with an absolute correlation of at least "threshold".
+    top_k = 10
+    threshold = 0.9
+    # Genes per tile, memory is about block_size x block_size x 4 bytes
+    # per thread.
+    block_size = 2000
+    workers = 4
+
+    df = read_df(input_file)
+    if value_cols is None:
+        value_cols = [col for col in df.select_dtypes("number").columns
+                      if col != gene_col]
+    df = df.dropna(subset=[gene_col])
+    complete = df[value_cols].notna().all(axis=1)
+    if not complete.all():
+        print(f"Genes with missing values left out: "
+              f"{text_color((~complete).sum(), 'yellow')}")
+        df = df[complete]
+    genes = df[gene_col].astype(str).to_numpy()
+    z = standardize(df[value_cols].to_numpy(), method)
+    print(f"Matrix: {z.shape[0]} genes x {z.shape[1]} samples")
+
+    output_file = output_folder / f"{input_file.stem}_{method}_edges.txt"
+    n_edges = 0
+    with open(output_file, "w", newline="", encoding="utf-8") as f:
+        for gene_a, gene_b, r in coexpression_edges(z, block_size, top_k,
+                                                    threshold, workers):
+            pd.DataFrame({"Gene_A": genes[gene_a],
+                          "Gene_B": genes[gene_b],
+                          "Correlation": r}).to_csv(f, sep='\t', index=False,
+                                                    header=f.tell() == 0)
+            n_edges += len(r)
+    print(f"Edges: {text_color(n_edges, 'green')}, "
+          f"output: {text_color(output_file, 'green')}")
+
+    time_end = time()
+    time_used = time_end - time_start
+    show_time(time_used, "Total time taken")
+
+
+if __name__=="__main__":
+    main()
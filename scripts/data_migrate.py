@@ -1,13 +1,100 @@
-import pandas as pd
+"""
+Convert Excel workbooks (all or selected sheets) to tab-separated text.
+"""
 from pathlib import Path
+from time import time, ctime
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from utilities import read_df, search_target_files, show_time, text_color
+
+__author__ = "Johnathan Lin <jagonball@g-mail.nsysu.edu.tw>"
+__email__ = "jagonball@g-mail.nsysu.edu.tw"
+
+
+def convert_sheet(file, sheet, output_file, cache_dir=None):
+    """Convert one sheet of a workbook to a tab-separated text file.
+
+    :param file: Path to the workbook.
+    :type file: str or Path
+    :param sheet: Sheet name or zero-indexed position.
+    :type sheet: str or int
+    :param output_file: Path to the output file.
+    :type output_file: Path
+    :param cache_dir: Folder of the "read_df" columnar cache, defaults to None
+    :type cache_dir: Path, optional
+    :return: The output file and the shape of the sheet.
+    :rtype: tuple(Path, tuple)
+    """
+    df = read_df(file, sheet_name=sheet, cache_dir=cache_dir)
+    df.to_csv(output_file, sep='\t', index=False)
+    return output_file, df.shape
+
+
+def list_sheets(files, sheets=None):
+    """List the (workbook, sheet, output name) to convert.
+
+    :param files: Paths to the workbooks.
+    :type files: list
+    :param sheets: Sheets to convert, defaults to None (all sheets)
+    :type sheets: list, optional
+    :return: The workbook, the sheet and the output file name of each job,
+        "<workbook>.txt" for a single sheet, otherwise "<workbook>_<sheet>.txt".
+    :rtype: list
+    """
+    jobs = []
+    for file in files:
+        file = Path(file)
+        file_sheets = sheets
+        if file_sheets is None:
+            with pd.ExcelFile(file) as excel:
+                file_sheets = excel.sheet_names
+        for sheet in file_sheets:
+            if len(file_sheets) == 1:
+                output_name = f"{file.stem}.txt"
+            else:
+                output_name = f"{file.stem}_{sheet}.txt"
+            jobs.append((file, sheet, output_name))
+    return jobs
+
+
+def main():
+    time_start = time()
+    print(f"data_migrate.py start time: {ctime(time_start)}")
+
+    input_folder = Path("D:/Repositories/25_01_Liver_Cancer/data")
+    # Workbooks to convert (accept wildcards).
+    file_list = ["Microarray_Huh7_Modified.xlsx"]
+    # Sheets to convert, None for all sheets.
+    sheets = [0]
+    output_folder = Path("D:/Repositories/25_01_Liver_Cancer/data")
+    # Output names of single-sheet workbooks, default "<workbook>.txt".
+    output_names = {"Microarray_Huh7_Modified.xlsx": "Microarray_Huh7_normalized.txt"}
+    # Columnar cache of the parsed sheets (ex: input_folder / ".read_df_cache"),
+    # only worth it when the same sheets are read again, None for no cache.
+    cache_dir = None
+    # Number of sheets converted in parallel.
+    workers = 4
 
-file = Path("D:/Repositories/25_01_Liver_Cancer/data/Microarray_Huh7_Modified.xlsx")
-output_folder = Path("D:/Repositories/25_01_Liver_Cancer/data")
-output_file = "Microarray_Huh7_normalized.txt"
+    files = search_target_files(file_list, input_folder)
+    jobs = list_sheets(files, sheets)
+    print(f"Converting {len(jobs)} sheet(s) of {len(files)} workbook(s)...")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for file, sheet, output_name in jobs:
+            ## Custom name of a single-sheet workbook.
+            if output_name == f"{file.stem}.txt":
+                output_name = output_names.get(file.name, output_name)
+            futures.append(executor.submit(convert_sheet, file, sheet,
+                                           output_folder / output_name,
+                                           cache_dir))
+        for future in futures:
+            output_file, shape = future.result()
+            print(f"{text_color(output_file.name, 'green')}: {shape}")
 
-df = pd.read_excel(file)
-print(df.shape)
-print(df.head())
+    time_end = time()
+    time_used = time_end - time_start
+    show_time(time_used, "Total time taken")
 
-df.to_csv(output_folder / output_file, sep='\t', index=False)
 
+if __name__=="__main__":
+    main()
@@ -0,0 +1,241 @@
+"""
+Differential expression between sample groups for every probe at once:
+log2 fold change, moderated t-statistic (empirical Bayes variance, as
+limma's eBayes) and BH-adjusted p-values.
+"""
+from pathlib import Path
+from time import time, ctime
+from concurrent.futures import ProcessPoolExecutor
+import sys
+import numpy as np
+import pandas as pd
+from scipy import stats
+from scipy.special import digamma, polygamma
+from utilities import read_df, p_adjust_bh, show_time, text_color
+
+__author__ = "Johnathan Lin <jagonball@g-mail.nsysu.edu.tw>"
+__email__ = "jagonball@g-mail.nsysu.edu.tw"
+
+
+def group_stats(matrix, design):
+    """Mean and number of values of every group, and the pooled residual
+    variance of every probe. Missing values are left out.
+
+    :param matrix: Probe x sample log2 expression.
+    :type matrix: ndarray
+    :param design: Group name of each sample column.
+    :type design: list
+    :return: The groups, the group means and counts (probe x group), the
+        residual variance and its degrees of freedom (per probe).
+    :rtype: tuple(list, ndarray, ndarray, ndarray, ndarray)
+    """
+    codes, groups = pd.factorize(pd.Series(design))
+    valid = ~np.isnan(matrix)
+    values = np.where(valid, matrix, 0)
+    ## Sample x group indicator, so every group is summed in one product.
+    indicator = np.zeros((len(design), len(groups)))
+    indicator[np.arange(len(design)), codes] = 1
+    counts = valid @ indicator
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = (values @ indicator) / counts
+        residuals = np.where(valid, matrix - means[:, codes], 0)
+        df_residual = counts.sum(axis=1) - (counts > 0).sum(axis=1)
+        variance = (residuals ** 2).sum(axis=1) / df_residual
+    variance[df_residual <= 0] = np.nan
+    return list(groups), means, counts, variance, df_residual
+
+
+def trigamma_inverse(x):
+    """Solve trigamma(y) = x for y by Newton's method (limma's
+    trigammaInverse).
+
+    :param x: Positive values.
+    :type x: ndarray
+    :rtype: ndarray
+    """
+    x = np.asarray(x, dtype=float)
+    y = 0.5 + 1 / x
+    for _ in range(50):
+        tri = polygamma(1, y)
+        delta = tri * (1 - tri / x) / polygamma(2, y)
+        y = y + delta
+        if np.all(-delta / y < 1e-8):
+            break
+    return y
+
+
+def fit_prior(variance, df_residual):
+    """Fit the prior of the probe variances, a scaled inverse chi-square
+    distribution (limma's fitFDist without covariate).
+
+    :param variance: Residual variance of every probe.
+    :type variance: ndarray
+    :param df_residual: Degrees of freedom of every probe.
+    :type df_residual: ndarray
+    :return: The prior degrees of freedom (inf if the variances agree more
+        than chance) and the prior variance.
+    :rtype: tuple(float, float)
+    """
+    ok = np.isfinite(variance) & (variance > 0) & (df_residual > 0)
+    s2, d = variance[ok], df_residual[ok]
+    z = np.log(s2) - digamma(d / 2) + np.log(d / 2)
+    z_mean = z.mean()
+    z_var = z.var(ddof=1) - polygamma(1, d / 2).mean()
+    if z_var > 0:
+        df_prior = 2 * float(trigamma_inverse(z_var))
+        var_prior = float(np.exp(z_mean + digamma(df_prior / 2)
+                                 - np.log(df_prior / 2)))
+    else:
+        df_prior = np.inf
+        var_prior = float(np.exp(z_mean))
+    return df_prior, var_prior
+
+
+def moderate_variance(variance, df_residual, df_prior, var_prior):
+    """Shrink each probe variance towards the prior variance.
+
+    :return: The posterior variance and its degrees of freedom.
+    :rtype: tuple(ndarray, ndarray)
+    """
+    variance = np.where(np.isnan(variance), var_prior, variance)
+    if np.isinf(df_prior):
+        return np.full(variance.shape, var_prior), np.full(variance.shape, np.inf)
+    df_total = df_residual + df_prior
+    var_post = (df_prior * var_prior + df_residual * variance) / df_total
+    return var_post, df_total
+
+
+def test_contrast(means, counts, var_post, df_total, index_a, index_b):
+    """Moderated t-test of group a against group b for every probe.
+
+    :param means: Group means, probe x group.
+    :type means: ndarray
+    :param counts: Group counts, probe x group.
+    :type counts: ndarray
+    :param var_post: Posterior variance of every probe.
+    :type var_post: ndarray
+    :param df_total: Degrees of freedom of the posterior variance.
+    :type df_total: ndarray
+    :param index_a: Column of group a (numerator of the fold change).
+    :type index_a: int
+    :param index_b: Column of group b.
+    :type index_b: int
+    :return: Columns "logFC", "AveExpr", "t", "P_Value" and "Q_Value".
+    :rtype: DataFrame
+    """
+    n_a, n_b = counts[:, index_a], counts[:, index_b]
+    log_fc = means[:, index_a] - means[:, index_b]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        average = (means[:, index_a] * n_a + means[:, index_b] * n_b) / (n_a + n_b)
+        t = log_fc / np.sqrt(var_post * (1 / n_a + 1 / n_b))
+    p_values = 2 * stats.t.sf(np.abs(t), df_total)
+    return pd.DataFrame({"logFC": log_fc,
+                         "AveExpr": average,
+                         "t": t,
+                         "P_Value": p_values,
+                         "Q_Value": p_adjust_bh(p_values)})
+
+
+def differential_expression(matrix, design, contrasts, workers=1):
+    """Test every contrast for every probe.
+
+    :param matrix: Probe x sample log2 expression.
+    :type matrix: ndarray
+    :param design: Group name of each sample column.
+    :type design: list
+    :param contrasts: Pairs of (group a, group b), fold change is a - b.
+    :type contrasts: list
+    :param workers: Number of processes for the contrasts, defaults to 1
+    :type workers: int, optional
+    :return: The result of each contrast, by "<a>_vs_<b>", and the prior
+        degrees of freedom and variance.
+    :rtype: tuple(dict, tuple)
+    """
+    matrix = np.asarray(matrix, dtype=float)
+    groups, means, counts, variance, df_residual = group_stats(matrix, design)
+    prior = fit_prior(variance, df_residual)
+    var_post, df_total = moderate_variance(variance, df_residual, *prior)
+    for group_a, group_b in contrasts:
+        for group in (group_a, group_b):
+            if group not in groups:
+                print(f"Group {text_color(group, 'red')} of contrast "
+                      f"{group_a} vs {group_b} is not in the design: {groups}")
+                sys.exit()
+
+    jobs = [(f"{a}_vs_{b}", groups.index(a), groups.index(b))
+            for a, b in contrasts]
+    results = {}
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {name: executor.submit(test_contrast, means, counts,
+                                             var_post, df_total, a, b)
+                       for name, a, b in jobs}
+            for name, future in futures.items():
+                results[name] = future.result()
+    else:
+        for name, a, b in jobs:
+            results[name] = test_contrast(means, counts, var_post, df_total, a, b)
+    return results, prior
+
+
+def label_regulation(df_result, q_cutoff=0.05, fc_cutoff=1.0):
+    """Label probes "up", "down" or "ns" for "go_enrichment.py".
+
+    :param df_result: A result of "differential_expression".
+    :type df_result: DataFrame
+    :param q_cutoff: Maximum q-value, defaults to 0.05
+    :type q_cutoff: float, optional
+    :param fc_cutoff: Minimum absolute log2 fold change, defaults to 1.0
+    :type fc_cutoff: float, optional
+    :rtype: ndarray
+    """
+    significant = (df_result["Q_Value"] < q_cutoff) \
+        & (df_result["logFC"].abs() >= fc_cutoff)
+    return np.select([significant & (df_result["logFC"] > 0),
+                      significant & (df_result["logFC"] < 0)],
+                     ["up", "down"], "ns")
+
+
+def main():
+    time_start = time()
+    print(f"differential_expression.py start time: {ctime(time_start)}")
+
+    input_file = Path("D:/Repositories/25_01_Liver_Cancer/data/Microarray_Huh7_normalized.txt")
+    output_folder = Path("D:/Repositories/25_01_Liver_Cancer/analysis")
+    # Probe annotation columns, kept in the outputs ("symbol" for "ncbi_data.py").
+    id_cols = ["ProbeName", "symbol"]
+    # Group of each log2 expression column.
+    design = {"Huh7_Ctrl_1": "Ctrl", "Huh7_Ctrl_2": "Ctrl", "Huh7_Ctrl_3": "Ctrl",
+              "Huh7_Treat_1": "Treat", "Huh7_Treat_2": "Treat", "Huh7_Treat_3": "Treat"}
+    # Contrasts (a, b), log2 fold change is a - b.
+    contrasts = [("Treat", "Ctrl")]
+    # Cutoffs of the "regulation" column.
+    q_cutoff = 0.05
+    fc_cutoff = 1.0
+    # Number of processes for the contrasts.
+    workers = 1
+
+    df = read_df(input_file, usecols=id_cols + list(design))
+    matrix = df[list(design)].to_numpy(dtype=float)
+    print(f"Matrix: {matrix.shape[0]} probes x {matrix.shape[1]} samples")
+    results, (df_prior, var_prior) = differential_expression(
+        matrix, list(design.values()), contrasts, workers)
+    print(f"Prior degrees of freedom: {df_prior:.3g}, "
+          f"prior variance: {var_prior:.3g}")
+
+    for name, df_result in results.items():
+        df_result["regulation"] = label_regulation(df_result, q_cutoff, fc_cutoff)
+        df_out = pd.concat([df[id_cols], df_result], axis=1)
+        output_file = output_folder / f"{input_file.stem}_{name}.txt"
+        df_out.to_csv(output_file, sep='\t', index=False)
+        counts = df_result["regulation"].value_counts()
+        print(f"{text_color(name, 'green')}: up {counts.get('up', 0)}, "
+              f"down {counts.get('down', 0)}")
+
+    time_end = time()
+    time_used = time_end - time_start
+    show_time(time_used, "Total time taken")
+
+
+if __name__=="__main__":
+    main()
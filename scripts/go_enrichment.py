@@ -0,0 +1,151 @@
+"""
+GO over-representation test for a foreground gene list, all terms at once.
+"""
+from pathlib import Path
+from time import time, ctime
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.stats import hypergeom
+from utilities import read_df, df_cat_filter, p_adjust_bh, show_time, text_color
+from go_terms import go_incidence, load_go_matrix
+
+__author__ = "Johnathan Lin <jagonball@g-mail.nsysu.edu.tw>"
+__email__ = "jagonball@g-mail.nsysu.edu.tw"
+
+## GO ID and name columns of the "ncbi_data.py" output, and the namespace.
+GO_TEXT_COLUMNS = [("GOBP_ID", "GOBP_NAME", "biological_process"),
+                   ("GOCC_ID", "GOCC_NAME", "cellular_component"),
+                   ("GOMF_ID", "GOMF_NAME", "molecular_function")]
+
+
+def matrix_from_table(df, gene_col):
+    """Build the gene x term matrix from the ";"-joined GO columns of an
+    annotated table. The first row of each gene is used.
+
+    :param df: The annotated table of "ncbi_data.py".
+    :type df: DataFrame
+    :param gene_col: The gene identifier column.
+    :type gene_col: str
+    :return: The genes, the term dictionary and the gene x term matrix.
+    :rtype: tuple(list, DataFrame, csr_matrix)
+    """
+    df = df.dropna(subset=[gene_col]).drop_duplicates(gene_col)
+    genes = df[gene_col].astype(str).tolist()
+    list_pairs = []
+    for id_col, name_col, namespace in GO_TEXT_COLUMNS:
+        if id_col not in df.columns:
+            continue
+        ids = df[id_col].fillna("").astype(str).str.split(";")
+        names = df[name_col].fillna("").astype(str).str.split(";") \
+            if name_col in df.columns else ids.map(lambda x: [None] * len(x))
+        ## Names are only kept if they line up with the IDs.
+        aligned = ids.str.len() == names.str.len()
+        names = names.where(aligned, ids.map(lambda x: [None] * len(x)))
+        df_pair = pd.DataFrame({"Query": genes,
+                                "GO_ID": ids.to_numpy(),
+                                "GO_Name": names.to_numpy()})
+        df_pair = df_pair.explode(["GO_ID", "GO_Name"])
+        df_pair = df_pair[df_pair["GO_ID"] != ""].assign(Namespace=namespace)
+        list_pairs.append(df_pair)
+    df_pairs = pd.concat(list_pairs).drop_duplicates(["Query", "GO_ID"])
+    df_terms, matrix = go_incidence(df_pairs, genes)
+    return genes, df_terms, matrix
+
+
+def go_enrichment(genes,
+                  df_terms,
+                  matrix,
+                  foreground,
+                  background=None,
+                  min_size=1):
+    """Hypergeometric (one-sided Fisher's exact) test of every GO term.
+
+    :param genes: Genes of the matrix rows, in order.
+    :type genes: list
+    :param df_terms: The term dictionary, row i is column i of the matrix.
+    :type df_terms: DataFrame
+    :param matrix: The gene x term matrix.
+    :type matrix: csr_matrix
+    :param foreground: The selected genes.
+    :type foreground: list
+    :param background: The background genes, defaults to None (all genes
+        of the matrix with at least one term)
+    :type background: list, optional
+    :param min_size: Minimum background genes of a tested term, defaults to 1
+    :type min_size: int, optional
+    :return: The tested terms with counts, fold enrichment, p-value and
+        BH-adjusted q-value, sorted by p-value.
+    :rtype: DataFrame
+    """
+    matrix = sparse.csr_matrix(matrix, dtype=np.int64)
+    matrix.data[:] = 1
+    gene_index = pd.Index(genes)
+    if background is None:
+        in_background = np.diff(matrix.indptr) > 0
+    else:
+        in_background = gene_index.isin(pd.Index(background))
+    in_foreground = gene_index.isin(pd.Index(foreground)) & in_background
+
+    ## Term counts in the background (K) and the foreground (k).
+    n_total = int(in_background.sum())
+    n_selected = int(in_foreground.sum())
+    term_total = np.asarray(in_background.astype(np.int64) @ matrix).ravel()
+    term_selected = np.asarray(in_foreground.astype(np.int64) @ matrix).ravel()
+    print(f"Foreground genes: {n_selected} of {len(set(foreground))}, "
+          f"background genes: {n_total}")
+
+    tested = term_total >= max(min_size, 1)
+    p_values = hypergeom.sf(term_selected[tested] - 1, n_total,
+                            term_total[tested], n_selected)
+    df_result = df_terms[tested].copy()
+    df_result["Selected"] = term_selected[tested]
+    df_result["Annotated"] = term_total[tested]
+    df_result["Expected"] = term_total[tested] * n_selected / max(n_total, 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        df_result["Fold_Enrichment"] = (df_result["Selected"]
+                                        / df_result["Expected"])
+    df_result["P_Value"] = p_values
+    df_result["Q_Value"] = p_adjust_bh(p_values)
+    return df_result.sort_values("P_Value", kind="stable").reset_index(drop=True)
+
+
+def main():
+    time_start = time()
+    print(f"go_enrichment.py start time: {ctime(time_start)}")
+
+    ## Annotated table of "ncbi_data.py" and the gene column.
+    input_file = Path("D:/Repositories/25_01_Liver_Cancer/analysis/Microarray_Huh7_normalized_annotate.txt")
+    gene_col = "symbol"
+    ## Gene x term matrix of "ncbi_data.py" (output prefix), used instead of
+    ## the GO text columns if set.
+    go_prefix = None  # Path("D:/Repositories/25_01_Liver_Cancer/analysis/Microarray_Huh7_normalized")
+    ## Foreground genes: rows of "category_col" in "condition".
+    category_col = "regulation"
+    condition = "up"
+    min_size = 5
+    output_folder = Path("D:/Repositories/25_01_Liver_Cancer/analysis/")
+
+    df = read_df(input_file)
+    df_foreground = df_cat_filter(df, category_col, condition)
+    foreground = df_foreground[gene_col].dropna().astype(str).tolist()
+    if go_prefix is None:
+        genes, df_terms, matrix = matrix_from_table(df, gene_col)
+    else:
+        genes, df_terms, matrix = load_go_matrix(go_prefix)
+    print(f"GO matrix: {matrix.shape[0]} genes x {matrix.shape[1]} terms")
+
+    df_result = go_enrichment(genes, df_terms, matrix, foreground,
+                              min_size=min_size)
+    print(f"Terms with q < 0.05: "
+          f"{text_color((df_result['Q_Value'] < 0.05).sum(), 'green')}")
+    output_file = output_folder / f"{input_file.stem}_GO_enrichment.txt"
+    df_result.to_csv(output_file, sep='\t', index=False)
+
+    time_end = time()
+    time_used = time_end - time_start
+    show_time(time_used, "Total time taken")
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Integer-coded GO terms and sparse gene x term incidence matrix.
+"""
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+__author__ = "Johnathan Lin <jagonball@g-mail.nsysu.edu.tw>"
+__email__ = "jagonball@g-mail.nsysu.edu.tw"
+
+## GO ID column, GO name column and namespace of the gene results.
+GO_COLUMNS = [("Gene Ontology Biological Process Go ID",
+               "Gene Ontology Biological Process Name",
+               "biological_process"),
+              ("Gene Ontology Cellular Component Go ID",
+               "Gene Ontology Cellular Component Name",
+               "cellular_component"),
+              ("Gene Ontology Molecular Function Go ID",
+               "Gene Ontology Molecular Function Name",
+               "molecular_function")]
+
+
+def go_pairs(df_go_rows):
+    """Collect the unique gene-term pairs from gene results.
+
+    :param df_go_rows: Gene results with a "Query" column.
+    :type df_go_rows: DataFrame
+    :return: Columns "Query", "GO_ID", "GO_Name" and "Namespace".
+    :rtype: DataFrame
+    """
+    list_pairs = []
+    for id_col, name_col, namespace in GO_COLUMNS:
+        if id_col not in df_go_rows.columns:
+            continue
+        df_pair = pd.DataFrame({"Query": df_go_rows["Query"],
+                                "GO_ID": df_go_rows[id_col],
+                                "GO_Name": df_go_rows.get(name_col),
+                                "Namespace": namespace})
+        list_pairs.append(df_pair.dropna(subset=["GO_ID"]))
+    if not list_pairs:
+        return pd.DataFrame(columns=["Query", "GO_ID", "GO_Name", "Namespace"])
+    return pd.concat(list_pairs).drop_duplicates(["Query", "GO_ID"])
+
+
+def go_incidence(df_pairs, genes):
+    """Build the term dictionary and the gene x term incidence matrix.
+
+    :param df_pairs: Gene-term pairs from "go_pairs".
+    :type df_pairs: DataFrame
+    :param genes: Genes of the matrix rows, in order.
+    :type genes: list
+    :return: The term dictionary (row i is column i of the matrix) and the
+        gene x term matrix (1 for annotated).
+    :rtype: tuple(DataFrame, csr_matrix)
+    """
+    df_pairs = df_pairs[df_pairs["Query"].isin(genes)]
+    codes, go_ids = pd.factorize(df_pairs["GO_ID"], sort=True)
+    df_terms = (df_pairs.drop_duplicates("GO_ID")
+                .set_index("GO_ID")
+                .reindex(go_ids)[["GO_Name", "Namespace"]]
+                .rename_axis("GO_ID")
+                .reset_index())
+    df_terms.insert(0, "Term_Index", np.arange(len(df_terms)))
+    rows = pd.Index(genes).get_indexer(df_pairs["Query"])
+    matrix = sparse.csr_matrix((np.ones(len(codes), dtype=np.uint8),
+                                (rows, codes)),
+                               shape=(len(genes), len(go_ids)))
+    return df_terms, matrix
+
+
+def save_go_matrix(output_prefix, genes, df_terms, matrix):
+    """Write "<prefix>_go_terms.txt", "<prefix>_go_genes.txt" and
+    "<prefix>_go_matrix.npz".
+
+    :param output_prefix: Path and file name prefix of the outputs.
+    :type output_prefix: Path
+    :param genes: Genes of the matrix rows, in order.
+    :type genes: list
+    :param df_terms: The term dictionary.
+    :type df_terms: DataFrame
+    :param matrix: The gene x term matrix.
+    :type matrix: csr_matrix
+    """
+    output_prefix = Path(output_prefix)
+    df_terms.to_csv(f"{output_prefix}_go_terms.txt", sep='\t', index=False)
+    pd.DataFrame({"Gene": genes}).to_csv(f"{output_prefix}_go_genes.txt",
+                                         sep='\t', index=False)
+    sparse.save_npz(f"{output_prefix}_go_matrix.npz", matrix)
+
+
+def load_go_matrix(output_prefix):
+    """Read the outputs of "save_go_matrix".
+
+    :param output_prefix: Path and file name prefix of the outputs.
+    :type output_prefix: Path
+    :return: The genes, the term dictionary and the gene x term matrix.
+    :rtype: tuple(list, DataFrame, csr_matrix)
+    """
+    genes = pd.read_table(f"{output_prefix}_go_genes.txt",
+                          dtype=str, keep_default_na=False)["Gene"].tolist()
+    df_terms = pd.read_table(f"{output_prefix}_go_terms.txt")
+    matrix = sparse.load_npz(f"{output_prefix}_go_matrix.npz").tocsr()
+    return genes, df_terms, matrix
@@ -0,0 +1,199 @@
+"""
+Client for the NCBI "datasets" command-line tool: token-bucket rate limit,
+retries with exponential backoff and jitter for transient failures, and a
+record of the identifiers that failed.
+"""
+import re
+import subprocess
+import random
+from time import monotonic, sleep
+from threading import Lock
+from tempfile import TemporaryFile
+import pandas as pd
+from utilities import Profiler
+
+__author__ = "Johnathan Lin <jagonball@g-mail.nsysu.edu.tw>"
+__email__ = "jagonball@g-mail.nsysu.edu.tw"
+
+## Requests per second allowed by NCBI, without and with an API key.
+NCBI_RPS = {False: 3, True: 10}
+
+## Error messages of failures worth retrying: throttling, server and
+## network errors. Status codes and words must stand alone, so an
+## identifier such as "ZNF500" in a message does not match.
+THROTTLE_ERRORS = re.compile(r"\b429\b|too many requests|rate limit",
+                             re.IGNORECASE)
+TRANSIENT_ERRORS = re.compile(r"\b429\b|too many requests|rate limit"
+                              r"|\b(500|502|503|504)\b|\btime(d)? ?out\b"
+                              r"|\btemporar(y|ily)\b|\bunexpected eof\b"
+                              r"|\bconnection (reset|refused|aborted|closed)\b"
+                              r"|\bservice unavailable\b",
+                              re.IGNORECASE)
+
+
+class TokenBucket:
+    """Rate limit shared by threads: "rate" tokens per second, up to
+    "burst" saved. The rate is halved on throttling and recovers step by
+    step on success.
+
+    :param rate: Tokens per second, None or 0 for no limit.
+    :type rate: float, optional
+    :param burst: Maximum saved tokens, defaults to 1
+    :type burst: float, optional
+    """
+    def __init__(self, rate=None, burst=1):
+        self.max_rate = rate or 0
+        self.rate = self.max_rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        if not self.max_rate:
+            return
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            wait_time = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait_time > 0:
+            sleep(wait_time)
+
+    def slow_down(self):
+        """Halve the rate, down to 1/10 of the set rate."""
+        with self.lock:
+            self.rate = max(self.rate / 2, self.max_rate / 10)
+
+    def speed_up(self):
+        """Raise the rate by 1/10 of the set rate, up to the set rate."""
+        with self.lock:
+            self.rate = min(self.rate + self.max_rate / 10, self.max_rate)
+
+
+class DatasetsClient:
+    """Run "datasets" commands with a rate limit and retries.
+
+    :param executable: Path to "datasets", defaults to "datasets"
+    :type executable: str, optional
+    :param api_key: NCBI API key, defaults to None
+    :type api_key: str, optional
+    :param max_rps: Maximum commands per second, defaults to None (the
+        NCBI limit of the API key tier)
+    :type max_rps: float, optional
+    :param max_retries: Retries of a transient failure, defaults to 5
+    :type max_retries: int, optional
+    :param backoff: First backoff in seconds, doubled for each retry,
+        defaults to 1.0
+    :type backoff: float, optional
+    :param max_backoff: Maximum backoff in seconds, defaults to 60.0
+    :type max_backoff: float, optional
+    :param profiler: Records the latency of every "datasets" call,
+        defaults to None
+    :type profiler: Profiler, optional
+    """
+    def __init__(self,
+                 executable="datasets",
+                 api_key=None,
+                 max_rps=None,
+                 max_retries=5,
+                 backoff=1.0,
+                 max_backoff=60.0,
+                 profiler=None):
+        self.executable = str(executable)
+        self.api_key = api_key
+        self.bucket = TokenBucket(max_rps or NCBI_RPS[bool(api_key)])
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.profiler = profiler or Profiler()
+        self.retries = 0
+        self.failed = {}
+        self.not_found = set()
+        self.lock = Lock()
+
+    def run(self, args, read_stdout):
+        """Run "datasets <args>", retrying transient failures. A non-zero
+        exit is an error even if stdout was read, output that can not be
+        parsed is retried as a transient failure.
+
+        :param args: Arguments after the executable.
+        :type args: list
+        :param read_stdout: Takes the stdout stream of the process, returns
+            the result.
+        :type read_stdout: Callable
+        :return: The result (None on error), the error message and if the
+            error was transient (retries ran out) rather than permanent.
+        :rtype: tuple(object, str, bool)
+        """
+        command = [self.executable] + list(args)
+        if self.api_key:
+            command += ["--api-key", self.api_key]
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            call_start = monotonic()
+            ## stderr goes to a file so a long message can not block the pipe.
+            parse_error = None
+            with TemporaryFile(mode="w+") as stderr:
+                with subprocess.Popen(command, stdout=subprocess.PIPE,
+                                      stderr=stderr, text=True,
+                                      encoding="utf-8") as process:
+                    try:
+                        result = read_stdout(process.stdout)
+                    ## Truncated or malformed output.
+                    except (ValueError, TypeError, AttributeError, KeyError) as e:
+                        parse_error = e
+                        ## Let the process finish for its exit code and error.
+                        process.stdout.read()
+                stderr.seek(0)
+                error = stderr.read().strip()
+            self.profiler.latency("datasets", monotonic() - call_start)
+            ## A failed process is an error, whatever it printed to stdout.
+            if process.returncode != 0:
+                error = error or f"datasets exited with {process.returncode}"
+                transient = bool(TRANSIENT_ERRORS.search(error))
+            elif parse_error is not None:
+                error = f"Malformed datasets output: {parse_error}"
+                transient = True
+            else:
+                self.bucket.speed_up()
+                return result, "", False
+            if not transient or attempt == self.max_retries:
+                return None, error, transient
+            if THROTTLE_ERRORS.search(error):
+                self.bucket.slow_down()
+            ## Full jitter: a random wait up to the exponential backoff.
+            with self.lock:
+                self.retries += 1
+            self.profiler.count("datasets_retries")
+            sleep(random.uniform(0, min(self.max_backoff,
+                                        self.backoff * 2 ** attempt)))
+        return None, error, True
+
+    def record(self, gene_results, failed=None):
+        """Record genes without a result as not found and the failed genes
+        with their error.
+
+        :param gene_results: Result DataFrame of each gene.
+        :type gene_results: dict
+        :param failed: Error of each failed gene, defaults to None
+        :type failed: dict, optional
+        """
+        with self.lock:
+            self.not_found.update(gene for gene, df_gene in gene_results.items()
+                                  if df_gene.empty)
+            self.failed.update(failed or {})
+
+    def failed_report(self, input_colname):
+        """The failed genes in a table that can be used as the input again.
+
+        :param input_colname: Column name of the identifiers.
+        :type input_colname: str
+        :return: Columns "input_colname" and "Error".
+        :rtype: DataFrame
+        """
+        return pd.DataFrame({input_colname: list(self.failed),
+                             "Error": list(self.failed.values())})
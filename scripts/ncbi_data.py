@@ -1,16 +1,696 @@
-import subprocess
 from pathlib import Path
 from time import time, strftime, gmtime, ctime
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
-from utilities import text_color, create_folder, show_time
-import io
+from utilities import text_color, create_folder, show_time, Profiler
+from annotation_cache import AnnotationCache
+from ncbi_offline import OfflineGeneStore
+from ncbi_client import DatasetsClient
+from side_outputs import SideOutputStore
+from go_terms import go_pairs, go_incidence, save_go_matrix
+import os
 import sys
+import json
 
 __author__ = "Johnathan Lin <jagonball@g-mail.nsysu.edu.tw>"
 __email__ = "jagonball@g-mail.nsysu.edu.tw"
 
-## To do: Create project folder, subfolder "multiple_values" and "multiple_genes"
+## Input types that can be mapped back from a combined gene table.
+BATCH_INPUT_TYPES = ["symbol", "gene-id"]
+
+## Single value fields of the gene report: "dataformat" field name to
+## its column name and the key in the json report.
+REPORT_FIELDS = {"symbol": ("Symbol", "symbol"),
+                 "gene-id": ("NCBI GeneID", "gene_id"),
+                 "description": ("Description", "description"),
+                 "gene-type": ("Gene Type", "type"),
+                 "name-id": ("Nomenclature ID",
+                             "nomenclature_authority.identifier"),
+                 "orientation": ("Orientation", "orientation"),
+                 "transcript-count": ("Transcripts", "transcript_count"),
+                 "protein-count": ("Proteins", "protein_count")}
+
+## Fields of plain string lists, one value joined by "," as in
+## "dataformat": column name and the key of the list in the json report.
+JOINED_FIELDS = {"synonyms": ("Synonyms", "synonyms"),
+                 "ensembl-geneids": ("Ensembl GeneIDs", "ensembl_gene_ids")}
+
+## GO term list fields of the gene report, one term per row: column name,
+## the key of the list in the json report and the key of each item.
+LIST_FIELDS = {"go-bp-id": ("Gene Ontology Biological Process Go ID",
+                            "gene_ontology.biological_processes", "go_id"),
+               "go-bp-name": ("Gene Ontology Biological Process Name",
+                              "gene_ontology.biological_processes", "name"),
+               "go-cc-id": ("Gene Ontology Cellular Component Go ID",
+                            "gene_ontology.cellular_components", "go_id"),
+               "go-cc-name": ("Gene Ontology Cellular Component Name",
+                              "gene_ontology.cellular_components", "name"),
+               "go-mf-id": ("Gene Ontology Molecular Function Go ID",
+                            "gene_ontology.molecular_functions", "go_id"),
+               "go-mf-name": ("Gene Ontology Molecular Function Name",
+                              "gene_ontology.molecular_functions", "name")}
+
+
+def plan_lookups(identifiers, input_type):
+    """Normalize identifiers and plan one lookup for each unique one.
+
+    Whitespace is stripped, accession versions (".1") and float gene IDs
+    (".0") are removed, and symbols differing only in case share their
+    most common spelling. Missing and blank identifiers are dropped.
+
+    :param identifiers: Identifier of each row.
+    :type identifiers: Series
+    :param input_type: "symbol", "gene-id", "accession" or "taxon".
+    :type input_type: str
+    :return: The normalized identifier of each row (NaN if dropped), the
+        unique identifiers to look up and the counts of the plan.
+    :rtype: tuple(Series, list, dict)
+    """
+    keys = identifiers.astype("string").str.strip()
+    if input_type == "accession":
+        keys = keys.str.upper().str.replace(r"\.\d+$", "", regex=True)
+    elif input_type == "gene-id":
+        keys = keys.str.replace(r"\.0$", "", regex=True)
+    keys = keys.mask(keys == "")
+    if input_type == "symbol":
+        upper = keys.str.upper()
+        df_spell = pd.DataFrame({"upper": upper, "key": keys}).dropna()
+        df_spell = df_spell.groupby(["upper", "key"], sort=False).size()
+        df_spell = df_spell.reset_index(name="count")
+        df_spell = df_spell.sort_values("count", ascending=False, kind="stable")
+        keys = upper.map(df_spell.drop_duplicates("upper").set_index("upper")["key"])
+    keys = keys.astype(object).where(keys.notna(), np.nan)
+    genes = keys.dropna().unique().tolist()
+    report = {"rows": len(keys),
+              "empty": int(keys.isna().sum()),
+              "lookups": len(genes),
+              "lookups_saved": len(keys) - len(genes)}
+    print(f"Rows: {report['rows']}, empty identifiers: {report['empty']}, "
+          f"unique lookups: {report['lookups']}, "
+          f"lookups saved: {text_color(report['lookups_saved'], 'green')}")
+    return keys, genes, report
+
+
+def get_path(report, path):
+    """Get a value from nested dicts by a dotted key, None if missing."""
+    for key in path.split("."):
+        if not isinstance(report, dict):
+            return None
+        report = report.get(key)
+    return report
+
+
+def parse_gene_report(lines, fields):
+    """Parse "datasets --as-json-lines" gene reports into a gene table.
+
+    Only the requested fields are read. Each gene takes as many rows as
+    its longest GO term list (at least one), GO terms are placed from the
+    first row of the gene and single values are repeated on every row.
+    Synonyms and Ensembl gene IDs are one value joined by ",", so the
+    unique values of each column are the same as in the "dataformat tsv
+    gene" output. The queried identifier(s) of each gene, if reported,
+    are kept in a "Query" column.
+
+    :param lines: Lines of the json-lines output, read one at a time.
+    :type lines: Iterable of str
+    :param fields: The fields to read, ex: "symbol,gene-id,go-bp-id".
+    :type fields: str
+    :return: The gene table, with the "dataformat" column names.
+    :rtype: DataFrame
+    """
+    fields = [field.strip() for field in fields.split(",")]
+    single = [REPORT_FIELDS[field] for field in fields if field in REPORT_FIELDS]
+    joined = [JOINED_FIELDS[field] for field in fields if field in JOINED_FIELDS]
+    lists = [LIST_FIELDS[field] for field in fields if field in LIST_FIELDS]
+    columns = {field[0]: [] for field in single + joined + lists}
+    columns["Query"] = []
+    for line in lines:
+        if not line.strip():
+            continue
+        report = json.loads(line)
+        ## A gene report, or a report match wrapping the gene and query.
+        if isinstance(report.get("gene"), dict):
+            query = ",".join(report.get("query", [])) or None
+            report = report["gene"]
+        elif "gene_id" in report:
+            query = None
+        else:  # Warnings or errors without a gene.
+            continue
+        list_values = []
+        for col, path, item_key in lists:
+            values = [item.get(item_key)
+                      for item in get_path(report, path) or []]
+            list_values.append((col, values))
+        n_rows = max([1] + [len(values) for _, values in list_values])
+        for col, path in single:
+            columns[col] += [get_path(report, path)] * n_rows
+        for col, path in joined:
+            columns[col] += [",".join(get_path(report, path) or []) or None] * n_rows
+        for col, values in list_values:
+            columns[col] += values + [None] * (n_rows - len(values))
+        columns["Query"] += [query] * n_rows
+    df = pd.DataFrame(columns)
+    for col in ["NCBI GeneID", "Transcripts", "Proteins"]:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype("Int64")
+    if df["Query"].isna().all():
+        df = df.drop(columns="Query")
+    return df
+
+
+def run_datasets(genes, input_type, taxon, fields, client):
+    """Run a single "datasets" query for one or more genes.
+
+    The json-lines output is parsed as it streams from the process.
+
+    :param genes: Gene symbols, NCBI gene IDs or RefSeq accessions.
+    :type genes: list
+    :param input_type: "symbol", "gene-id", "accession" or "taxon".
+    :type input_type: str
+    :param taxon: The "--taxon" value.
+    :type taxon: str
+    :param fields: The fields to read, ex: "symbol,gene-id,go-bp-id".
+    :type fields: str
+    :param client: Runs the command with the rate limit and retries.
+    :type client: DatasetsClient
+    :return: The combined result (None on error), the error message and if
+        the error was transient.
+    :rtype: tuple(DataFrame, str, bool)
+    """
+    args = ["summary", "gene", input_type]
+    args += list(genes)
+    args += ["--taxon", taxon, "--as-json-lines"]
+    return client.run(args, lambda stdout: parse_gene_report(stdout, fields))
+
+
+def split_gene_results(df_batch, genes, input_type):
+    """Split a combined gene table back to each queried gene.
+
+    Genes are matched by the "Query" column if reported by "datasets".
+    Otherwise a symbol query matches a gene by its "Symbol", or if no gene
+    of the batch has that symbol, by one of its "Synonyms" (case-
+    insensitive), so another gene of the batch listing it as a synonym
+    does not change the result. A gene-id query matches by "NCBI GeneID".
+    All rows of the matched gene(s) are returned, as a single-gene query
+    would do.
+
+    :param df_batch: The combined result of one "datasets" query.
+    :type df_batch: DataFrame
+    :param genes: The queried genes.
+    :type genes: list
+    :param input_type: "symbol" or "gene-id".
+    :type input_type: str
+    :return: Result DataFrame of each queried gene.
+    :rtype: dict
+    """
+    df_query = df_batch.get("Query")
+    df_batch = df_batch.drop(columns="Query", errors="ignore")
+    empty = df_batch.iloc[0:0]
+    if df_batch.empty:
+        return {gene: empty for gene in genes}
+    id_col = "NCBI GeneID"
+    df_keys = df_batch[[id_col]].assign(key=df_batch[id_col].astype(str))
+    if df_query is not None:
+        df_keys = df_batch[[id_col]].assign(key=df_query.str.split(","))
+        df_keys = df_keys.explode("key").dropna()
+        df_keys["key"] = df_keys["key"].str.strip()
+        if input_type == "symbol":
+            df_keys["key"] = df_keys["key"].str.upper()
+    elif input_type == "symbol":
+        df_keys = df_batch[[id_col]].assign(key=df_batch["Symbol"]).dropna()
+        df_keys["key"] = df_keys["key"].astype(str).str.strip().str.upper()
+        if "Synonyms" in df_batch.columns:
+            df_syn = df_batch[[id_col]].assign(
+                key=df_batch["Synonyms"].dropna().astype(str).str.split(","))
+            df_syn = df_syn.explode("key").dropna()
+            df_syn["key"] = df_syn["key"].str.strip().str.upper()
+            ## An official symbol in the batch takes precedence.
+            df_syn = df_syn[~df_syn["key"].isin(df_keys["key"])]
+            df_keys = pd.concat([df_keys, df_syn])
+    dict_ids = df_keys.drop_duplicates().groupby("key", sort=False)[id_col].unique()
+    dict_rows = df_batch.groupby(id_col, sort=False).indices
+
+    gene_results = {}
+    for gene in genes:
+        key = gene.strip()
+        if input_type == "symbol":
+            key = key.upper()
+        if key in dict_ids.index:
+            rows = np.concatenate([dict_rows[gene_id]
+                                   for gene_id in dict_ids[key]])
+            gene_results[gene] = df_batch.iloc[np.sort(rows)]
+        else:
+            gene_results[gene] = empty
+    return gene_results
+
+
+def lookup_batch(batch, input_type, taxon, fields, client):
+    """Query one batch of genes, retry gene by gene if the batch failed
+    with a permanent error (ex: one invalid identifier). A batch that ran
+    out of transient retries (ex: an outage) is not split, its genes are
+    recorded as failed for a rerun. Failed genes are recorded in the client.
+
+    :param batch: Genes to query.
+    :type batch: list
+    :param input_type: "symbol", "gene-id", "accession" or "taxon".
+    :type input_type: str
+    :param taxon: The "--taxon" value.
+    :type taxon: str
+    :param fields: The fields to read, ex: "symbol,gene-id,go-bp-id".
+    :type fields: str
+    :param client: The "datasets" client shared by all workers.
+    :type client: DatasetsClient
+    :return: Result DataFrame of each gene, failed genes are not included.
+    :rtype: dict
+    """
+    df_batch, error, transient = run_datasets(batch, input_type, taxon,
+                                              fields, client)
+    if df_batch is None:
+        if len(batch) == 1 or transient:
+            name = batch[0] if len(batch) == 1 else f"{len(batch)} genes"
+            print(f"{text_color('Error', 'bright_red')}: {name}: {error}")
+            client.record({}, {gene: error for gene in batch})
+            return {}
+        ## Retry the failed batch one gene at a time.
+        gene_results = {}
+        for gene in batch:
+            gene_results.update(lookup_batch([gene], input_type,
+                                             taxon, fields, client))
+        return gene_results
+    if len(batch) == 1:
+        gene_results = {batch[0]: df_batch.drop(columns="Query", errors="ignore")}
+    else:
+        gene_results = split_gene_results(df_batch, batch, input_type)
+    client.record(gene_results)
+    return gene_results
+
+
+def lookup_genes(genes,
+                 input_type,
+                 taxon,
+                 fields,
+                 batch_size=100,
+                 workers=1,
+                 client=None):
+    """Query "datasets" in batches of genes, one process for each batch.
+
+    Batches run concurrently in a thread pool of "workers" threads, the
+    results are collected in the order of the batches. A failed batch is
+    queried again gene by gene, so one bad identifier does not cost the
+    whole batch. Input types other than "symbol" and "gene-id" are always
+    queried one at a time.
+
+    :param genes: Genes to query, duplicates are queried once.
+    :type genes: list
+    :param input_type: "symbol", "gene-id", "accession" or "taxon".
+    :type input_type: str
+    :param taxon: The "--taxon" value.
+    :type taxon: str
+    :param fields: The fields to read, ex: "symbol,gene-id,go-bp-id".
+    :type fields: str
+    :param batch_size: Number of genes for each query, defaults to 100
+    :type batch_size: int, optional
+    :param workers: Number of concurrent queries, defaults to 1
+    :type workers: int, optional
+    :param client: The "datasets" client, defaults to None (a client with
+        the NCBI limit without API key)
+    :type client: DatasetsClient, optional
+    :return: Result DataFrame of each gene, failed genes are not included.
+    :rtype: dict
+    """
+    if client is None:
+        client = DatasetsClient()
+    genes = list(dict.fromkeys(str(gene) for gene in genes))
+    if input_type not in BATCH_INPUT_TYPES:
+        batch_size = 1
+    batches = [genes[start:start + batch_size]
+               for start in range(0, len(genes), batch_size)]
+    print(f"Querying {len(genes)} genes in {len(batches)} batch(es) "
+          f"with {workers} worker(s)...")
+    gene_results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(lookup_batch, batch, input_type,
+                                   taxon, fields, client)
+                   for batch in batches]
+        for n, future in enumerate(futures, start=1):
+            gene_results.update(future.result())
+            print(f"Batch {n}/{len(batches)} done.")
+    return gene_results
+
+
+def lookup_genes_cached(genes,
+                        input_type,
+                        taxon,
+                        fields,
+                        cache,
+                        refresh=False,
+                        **kwargs):
+    """Look up genes from the cache first, query "datasets" for the rest
+    and store the new results to the cache.
+
+    :param genes: Genes to query.
+    :type genes: list
+    :param input_type: "symbol", "gene-id", "accession" or "taxon".
+    :type input_type: str
+    :param taxon: The "--taxon" value.
+    :type taxon: str
+    :param fields: The fields to read, ex: "symbol,gene-id,go-bp-id".
+    :type fields: str
+    :param cache: The annotation cache.
+    :type cache: AnnotationCache
+    :param refresh: Ignore cached results and query all genes, defaults to False
+    :type refresh: bool, optional
+    :return: Result DataFrame of each gene, failed genes are not included.
+    :rtype: dict
+    """
+    genes = list(dict.fromkeys(str(gene) for gene in genes))
+    gene_results = {}
+    if not refresh:
+        gene_results = cache.get(input_type, taxon, fields, genes)
+    print(f"Cached genes: {len(gene_results)} of {len(genes)}")
+    genes = [gene for gene in genes if gene not in gene_results]
+    if genes:
+        new_results = lookup_genes(genes, input_type, taxon, fields, **kwargs)
+        cache.put(input_type, taxon, fields, new_results)
+        gene_results.update(new_results)
+    return gene_results
+
+
+def join_unique(df_long, col):
+    """Join the unique non-missing values of a column for each query.
+
+    :param df_long: Gene results with a "Query" column.
+    :type df_long: DataFrame
+    :param col: The column to collapse.
+    :type col: str
+    :return: Values joined by ";" in order of appearance, and the number
+        of unique values, for each query with any value.
+    :rtype: tuple(Series, Series)
+    """
+    df_val = df_long[["Query", col]].dropna().drop_duplicates()
+    values = df_val[col]
+    ## Counts read as float because of missing values in other genes.
+    if values.dtype.kind == "f" and (values % 1 == 0).all():
+        values = values.astype("int64")
+    ## One stable sort by query, then cut the strings at the query bounds.
+    codes, queries = pd.factorize(df_val["Query"])
+    queries = pd.Index(queries, name="Query")
+    counts = np.bincount(codes, minlength=len(queries))
+    if not len(queries):
+        return pd.Series(index=queries, dtype=object), pd.Series(counts, index=queries)
+    strings = values.astype(str).to_numpy(dtype=object)
+    strings = strings[np.argsort(codes, kind="stable")]
+    joined = [";".join(part) for part in np.split(strings, np.cumsum(counts)[:-1])]
+    return pd.Series(joined, index=queries, name=col), pd.Series(counts, index=queries)
+
+
+def annotate_genes(gene_results, match_method, dict_col, dict_go, verbose=True):
+    """Collapse the gene results to one annotation row for each gene.
+
+    A gene with more than one matched "Symbol" is reduced to the rows of
+    its identical symbol, or skipped (empty values) if there is none.
+    GO terms are collected from all rows in "all" mode, and from the
+    reduced rows in "strict" mode.
+
+    :param gene_results: Result DataFrame of each gene.
+    :type gene_results: dict
+    :param match_method: "all" or "strict".
+    :type match_method: str
+    :param dict_col: Result columns to annotate and their output names.
+    :type dict_col: dict
+    :param dict_go: Result GO columns to annotate and their output names.
+    :type dict_go: dict
+    :param verbose: Print genes with more than one symbol or value,
+        defaults to True
+    :type verbose: bool, optional
+    :return: The annotation (indexed by gene), rows of genes with more
+        than one symbol, rows of genes with more than one value and the
+        rows GO terms are collected from.
+    :rtype: tuple(DataFrame, DataFrame, DataFrame, DataFrame)
+    """
+    out_cols = list(dict_go.values()) + list(dict_col.values())
+    gene_results = {gene: df for gene, df in gene_results.items()
+                    if not df.empty}
+    if not gene_results:
+        empty = pd.DataFrame(columns=["Query"])
+        return pd.DataFrame(columns=out_cols), empty, empty, empty
+    df_long = pd.concat(gene_results, names=["Query", None])
+    df_long = df_long.reset_index(level=0).reset_index(drop=True)
+    queries = pd.Index(gene_results.keys())
+
+    ## Genes with more than one symbol, and if the gene is one of them.
+    df_symbol = df_long[["Query", "Symbol"]].drop_duplicates()
+    n_symbol = df_symbol.groupby("Query", sort=False).size()
+    exact = (df_symbol["Symbol"] == df_symbol["Query"]).groupby(
+        df_symbol["Query"], sort=False).any()
+    multiple = df_long["Query"].map(n_symbol > 1)
+    reduce = multiple & df_long["Query"].map(exact)
+    skip = multiple & ~reduce
+    identical = df_long["Symbol"] == df_long["Query"]
+    df_mgenes = df_long[multiple]
+    if verbose:
+        for gene, df in df_symbol[df_symbol["Query"].map(n_symbol > 1)].groupby(
+                "Query", sort=False):
+            print(f"{gene} has more than 1 match: {df['Symbol'].to_numpy()}")
+
+    df_annot = pd.DataFrame(index=queries, columns=out_cols, dtype=object)
+    ## Annotate GO terms, "" for no matching terms.
+    if match_method == "strict":
+        df_go_rows = df_long[~reduce | identical]
+    elif match_method == "all":
+        df_go_rows = df_long
+    else:
+        print(f'Error: please check "match_method".')
+        sys.exit()
+    for col in dict_go:
+        terms, _ = join_unique(df_go_rows, col)
+        df_annot[dict_go[col]] = terms.reindex(queries).fillna("")
+
+    ## Annotate additional information, "" for skipped genes.
+    df_col_rows = df_long[~multiple | (reduce & identical)]
+    mvalues = pd.Index([])
+    for col in dict_col:
+        values, counts = join_unique(df_col_rows, col)
+        if verbose:
+            for gene in counts.index[counts > 1]:
+                print(f"{gene} has more than 1 value for {col}: {values[gene]}")
+        mvalues = mvalues.union(counts.index[counts > 1])
+        df_annot[dict_col[col]] = values.reindex(queries)
+    df_annot.loc[queries.isin(df_long.loc[skip, "Query"]),
+                 list(dict_col.values())] = ""
+    df_mvalues = df_col_rows[df_col_rows["Query"].isin(mvalues)]
+    return df_annot, df_mgenes, df_mvalues, df_go_rows
+
+
+def build_go_matrix(side_store, output_prefix):
+    """Write the GO term dictionary and the gene x term matrix of the
+    genes annotated with "go_matrix" in "annotate_table".
+
+    GO terms are collected by the same "match_method" rules as the text
+    columns. Genes without any term are kept as empty rows.
+
+    :param side_store: Store with the "go_pairs" of the genes.
+    :type side_store: SideOutputStore
+    :param output_prefix: Path and file name prefix of the outputs.
+    :type output_prefix: Path
+    """
+    genes = side_store.genes("go_pairs")
+    df_pairs = side_store.read("go_pairs").dropna(subset=["GO_ID"])
+    df_terms, matrix = go_incidence(df_pairs, genes)
+    save_go_matrix(output_prefix, genes, df_terms, matrix)
+    print(f"GO matrix: {matrix.shape[0]} genes x {matrix.shape[1]} terms, "
+          f"{matrix.nnz} annotations")
+
+
+def annotate_table(df,
+                   input_colname,
+                   input_type,
+                   lookup,
+                   match_method,
+                   dict_col,
+                   dict_go,
+                   side_store,
+                   profiler=None,
+                   go_matrix=False):
+    """Look up the genes of a table and add the annotation columns.
+
+    :param df: The input table.
+    :type df: DataFrame
+    :param input_colname: The column of gene identifiers.
+    :type input_colname: str
+    :param input_type: "symbol", "gene-id", "accession" or "taxon".
+    :type input_type: str
+    :param lookup: Takes a list of genes, returns the result of each gene.
+    :type lookup: Callable
+    :param match_method: "all" or "strict".
+    :type match_method: str
+    :param dict_col: Result columns to annotate and their output names.
+    :type dict_col: dict
+    :param dict_go: Result GO columns to annotate and their output names.
+    :type dict_go: dict
+    :param side_store: Store of the gene results and of the genes with
+        more than one symbol or value.
+    :type side_store: SideOutputStore
+    :param profiler: Times the lookup, aggregate, merge and write stages,
+        defaults to None
+    :type profiler: Profiler, optional
+    :param go_matrix: Also store the GO terms of each gene as "go_pairs"
+        for "build_go_matrix", defaults to False
+    :type go_matrix: bool, optional
+    :return: The annotated table and the counts of the lookup plan.
+    :rtype: tuple(DataFrame, dict)
+    """
+    if profiler is None:
+        profiler = Profiler()
+    ## Look up each unique identifier once.
+    gene_keys, genes, lookup_report = plan_lookups(df[input_colname],
+                                                   input_type)
+    with profiler.stage("lookup"):
+        gene_results = lookup(genes)
+
+    ## Store the results of each gene.
+    with profiler.stage("write"):
+        side_store.write_results(gene_results)
+
+    ## Collapse the result rows of each gene into the annotation columns.
+    with profiler.stage("aggregate"):
+        df_annot, df_mgenes, df_mvalues, df_go_rows = annotate_genes(
+            gene_results, match_method, dict_col, dict_go)
+    with profiler.stage("write"):
+        side_store.write("multiple_genes", df_mgenes)
+        side_store.write("multiple_values", df_mvalues)
+        if go_matrix:
+            df_pairs = go_pairs(df_go_rows)
+            ## An empty row for each gene without GO terms.
+            no_terms = pd.Index(genes).difference(df_pairs["Query"], sort=False)
+            ## Genes of earlier chunks keep their rows and order.
+            side_store.write("go_pairs", pd.concat(
+                [df_pairs, pd.DataFrame({"Query": no_terms})]), replace=False)
+
+    ## Broadcast the annotation to every row of the gene.
+    with profiler.stage("merge"):
+        df_annot = df_annot.reindex(gene_keys)
+        df = pd.concat([df.drop(columns=df_annot.columns, errors="ignore"),
+                        df_annot.set_axis(df.index)], axis=1)
+    profiler.count("rows", len(df))
+    profiler.count("genes", len(genes))
+    return df, lookup_report
+
+
+def journal_path(output_file):
+    """Path to the journal of "annotate_stream" for an output file."""
+    return output_file.with_name(f"{output_file.name}.journal")
+
+
+def input_state(input_file):
+    """Path, size and modified time of the input, as kept in the journal."""
+    stat = Path(input_file).stat()
+    return {"input_file": str(input_file),
+            "input_size": stat.st_size,
+            "input_mtime_ns": stat.st_mtime_ns}
+
+
+def read_journal(input_file, output_file, verbose=True):
+    """The journal of an unfinished "annotate_stream" run of the input.
+
+    A journal of another input, or of the input before it was changed
+    (size or modified time), is not resumed.
+
+    :param verbose: Warn if the input changed, defaults to True
+    :type verbose: bool, optional
+    :return: The journal to resume from, None to start a new run.
+    :rtype: dict
+    """
+    journal_file = journal_path(output_file)
+    if not (journal_file.exists() and output_file.exists()):
+        return None
+    with open(journal_file) as f:
+        journal = json.load(f)
+    if journal["input_file"] != str(input_file):
+        return None
+    if any(journal.get(key) != value
+           for key, value in input_state(input_file).items()):
+        if verbose:
+            print(f"{text_color('Warning', 'bright_yellow')}: "
+                  f"{input_file.name} changed since the last run, "
+                  f"starting over.")
+        return None
+    return journal
+
+
+def annotate_stream(input_file,
+                    output_file,
+                    chunk_size,
+                    annotate_chunk,
+                    profiler=None):
+    """Annotate a large table chunk by chunk, appending to the output.
+
+    A journal next to the output records the rows and output bytes done
+    after each chunk, with the size and modified time of the input. If a
+    run stops early, the next run of the unchanged input truncates the
+    output to the last finished chunk and continues from the next row.
+    The journal is removed when the whole table is done.
+
+    :param input_file: Path to the tab-separated input table.
+    :type input_file: Path
+    :param output_file: Path to the tab-separated output table.
+    :type output_file: Path
+    :param chunk_size: Number of rows to read and annotate at a time.
+    :type chunk_size: int
+    :param annotate_chunk: Takes a chunk, returns the annotated chunk and
+        the counts of its lookup plan.
+    :type annotate_chunk: Callable
+    :param profiler: Times the read and write stages, defaults to None
+    :type profiler: Profiler, optional
+    :return: The counts of the lookup plans, summed over the chunks.
+    :rtype: dict
+    """
+    if profiler is None:
+        profiler = Profiler()
+    journal_file = journal_path(output_file)
+    journal = read_journal(input_file, output_file)
+    if journal is None:
+        journal = {**input_state(input_file), "rows_done": 0,
+                   "output_bytes": 0}
+    else:
+        print(f"Resuming from row {journal['rows_done'] + 1} "
+              f"of {input_file.name}...")
+    rows_done = journal["rows_done"]
+    with open(output_file, "a+b") as f:
+        f.truncate(journal["output_bytes"])
+
+    lookup_report = {}
+    reader = pd.read_table(input_file,
+                           sep='\t',
+                           chunksize=chunk_size,
+                           skiprows=lambda i: 0 < i <= rows_done)
+    while True:
+        with profiler.stage("read"):
+            chunk = next(reader, None)
+        if chunk is None:
+            break
+        df_chunk, chunk_report = annotate_chunk(chunk)
+        for key, value in chunk_report.items():
+            lookup_report[key] = lookup_report.get(key, 0) + value
+        with profiler.stage("write"), \
+                open(output_file, "a", newline="", encoding="utf-8") as f:
+            df_chunk.to_csv(f, sep='\t', index=False,
+                            header=journal["rows_done"] == 0)
+            f.flush()
+            os.fsync(f.fileno())
+            journal["output_bytes"] = f.tell()
+        journal["rows_done"] += len(chunk)
+        ## Replace the journal in one step, so it is never half written.
+        temp_file = journal_file.with_name(f"{journal_file.name}.tmp")
+        with open(temp_file, "w") as f:
+            json.dump(journal, f)
+        os.replace(temp_file, journal_file)
+        print(f"Rows done: {journal['rows_done']}")
+    if journal_file.exists():
+        journal_file.unlink()
+    return lookup_report
+
 
 def main():
     time_start = time()
@@ -27,41 +707,66 @@ def main():
     output_folder = Path("C:/Users/CSBM_JL/OneDrive/Documents/[精準醫學博士班]/250423_Irisin_RNAeq/data_analysis/annotate")
     ## Create subfolder for outputs.
     project_folder = create_folder(project_name, output_folder)
-    mvalue_folder = create_folder("multiple_values", project_folder)
-    mgenes_folder = create_folder("multiple_genes", project_folder)
+    # Gene results and genes with more than one symbol or value, query the
+    # ambiguous genes of the last run with "side_outputs.py".
+    side_store = SideOutputStore(project_folder / "side_outputs.sqlite")
     # Get gene metadata by NCBI gene ID, gene symbol or RefSeq accession.
     input_type = "symbol"  # "gene-id" "accession" "taxon"
     # Collect GO terms from 
     # 1. "all": all returned results.
     # 2. "strict": only from the identical gene symbol.
     match_method = "all"  # "all" or "strict"
+    # Annotation backend:
+    # 1. "datasets": query the NCBI "datasets" command-line tool.
+    # 2. "offline": look up a local store built by "ncbi_offline.py".
+    backend = "datasets"  # "datasets" or "offline"
+    offline_store = Path("D:/Repositories/ncbi_gene/ncbi_gene_human.sqlite")
+    # Number of genes sent to each "datasets" query.
+    batch_size = 100
+    # Number of concurrent "datasets" queries and the maximum queries per
+    # second (None for the NCBI limit: 3 without an API key, 10 with).
+    workers = 4
+    max_rps = None
+    # Path to "datasets", the NCBI API key (None for no key) and the retries
+    # of a throttled or failed query, with exponential backoff and jitter.
+    # Genes that still fail are written to "<input>_failed.txt", which can
+    # be used as "input_file" for a rerun.
+    datasets_path = "datasets"
+    api_key = None
+    max_retries = 5
+    # Annotation cache, entries expire after "cache_ttl_days" and the least
+    # recently used ones are evicted over "cache_max_mb". Set "refresh_cache"
+    # to query all genes again.
+    cache_file = output_folder / "ncbi_cache.sqlite"
+    cache_ttl_days = 90
+    cache_max_mb = 1024
+    refresh_cache = False
     
     
-    df = pd.read_table(input_file, sep='\t')
-    print(f"The shape of df: {df.shape}")
-    # print(df)
-
-    # df_test = df.iloc[305:310, :].copy()
-    df_test = df.copy()
-    print(f"The shape of df_test: {df_test.shape}")
+    # Rows to read and annotate at a time, the output is appended after
+    # each chunk and a rerun continues after the last finished chunk.
+    # None to annotate the whole table at once.
+    chunk_size = 5000
+    # Write the GO term dictionary and a sparse gene x term matrix (.npz),
+    # and if to keep the ";"-joined GO text columns in the output table.
+    go_matrix = True
+    go_text_columns = True
+    # Write a JSON run report (stage times, "datasets" latency histogram,
+    # cache hits and misses, peak memory) as "<output>_profile.json", and
+    # if to trace the peak Python memory (slower).
+    profile = True
+    profile_memory = False
     
-    # # gene_list = ["WIPI2", "KIAA1549L", "ZG16B"]
-    # gene_list = df_test[input_colname]
-    ## Showing fields please refer to: https://www.ncbi.nlm.nih.gov/datasets/docs/v2/command-line-tools/using-dataformat/gene-data-reports/
-    fields_command = ["--taxon",
-                      "human",
-                      "--as-json-lines",
-                      "|",
-                      "dataformat",
-                      "tsv", 
-                      "gene", 
-                      "--fields",
-                      "symbol,gene-id,synonyms,description,ensembl-geneids,gene-type,\
-                      go-bp-id,go-bp-name,\
-                      go-cc-id,go-cc-name,\
-                      go-mf-id,go-mf-name,\
-                      name-id,orientation,transcript-count,protein-count"]
     
+    ## Fields to read from the "datasets" json-lines gene report, named as
+    ## "dataformat" fields, please refer to: https://www.ncbi.nlm.nih.gov/datasets/docs/v2/command-line-tools/using-dataformat/gene-data-reports/
+    taxon = "human"
+    fields = "symbol,gene-id,synonyms,description,ensembl-geneids,gene-type,\
+              go-bp-id,go-bp-name,\
+              go-cc-id,go-cc-name,\
+              go-mf-id,go-mf-name,\
+              name-id,orientation,transcript-count,protein-count"
+
     ## Columns to annotate.
     dict_col = {"NCBI GeneID": "Gene_ID",
                 "Synonyms": "Synonyms",
@@ -80,145 +785,93 @@ def main():
                "Gene Ontology Molecular Function Name": "GOMF_NAME"}
     
     
-    for i, row in df_test.iterrows():
-        # print(i)
-        # print(row)
-        gene = row[input_colname]
-        print(gene)
-        # df_test.loc[i, "test"] = f'test{i}'
-
-        dataset_command = ["datasets", "summary", "gene", input_type]
-        dataset_command.append(gene)
-        command = dataset_command + fields_command
-
-        ## Run the command and pass result to a DataFrame.
-        # Execute the command and capture the output.
-        result = subprocess.run(command, shell=True, capture_output=True, text=True)
-        # print(type(result.stdout))
-        # Check for errors.
-        if result.returncode != 0:
-            print("Error:", result.stderr)
-        else:
-            if result.stdout != "":
-                # Convert the tsv output to a Pandas DataFrame.
-                df_gene = pd.read_csv(io.StringIO(result.stdout), sep="\t")
-
-                ## Display the DataFrame.
-                # print(df_gene)
-                # Write to file.
-                output_file = output_folder / "temp_gene_results" / f"{gene}.txt"
-                df_gene.to_csv(output_file, sep='\t', index=False)
-
-                ## Check if there are multiple symbols.
-                list_symbol = df_gene["Symbol"].unique()
-                # print(list_symbol)
-                if len(list_symbol) > 1:
-                    print(f"{gene} has more than 1 match: {list_symbol}")
-                    # Write to file.
-                    output_file = mgenes_folder / f"{gene}.txt"
-                    df_gene.to_csv(output_file, sep='\t', index=False)
-
-                ## Skip the gene if "strict" mode and no exact match in the result.
-                skip = False
-                # GO term annotation method, filter symbol if set to "strict".
-                if match_method == "strict":
-                    if len(list_symbol) > 1:
-                        ## Check if "gene" is within the list.
-                        if gene in list_symbol:
-                            df_gene = df_gene[df_gene["Symbol"] == gene]
-                        else:
-                            skip = True
-                elif match_method == "all":
-                    pass
-                else:
-                    print(f'Error: please check "match_method".')
-                    sys.exit()
-
-
-                ## Annotate GO terms from df_gene.
-                for col in dict_go:
-                    unique_terms = df_gene[col].unique()
-                    # print(unique_terms)
-                    terms = ""   ## Default for no matching terms.
-                    if len(unique_terms) > 1:   ## More than one unique terms.
-                        ## Check if there is missing value "nan" in the array, remove them.
-                        if any(type(x) == float for x in unique_terms):
-                            unique_terms = unique_terms[~pd.isna(unique_terms)]
-                        # print(unique_terms)
-                        terms = ';'.join(unique_terms)
-                    else:    ## Only one unique terms.
-                        ## If there's no matching term, the array is [nan] with dtype "float64".
-                        if not unique_terms.dtype == "float64":
-                            terms = unique_terms[0]
-                    # print(dict_go[col])
-                    # print(terms)
-                    df_test.loc[i, dict_go[col]] = terms
-
-
-                # Filter symbol for additional annotation.
-                if not match_method == "strict":
-                    if len(list_symbol) > 1:
-                        ## Check if "gene" is within the list.
-                        if gene in list_symbol:
-                            df_gene = df_gene[df_gene["Symbol"] == gene]
-                        else:
-                            skip = True
-
-
-                ## Annotate additional information.
-                for col in dict_col:
-                    unique_value = df_gene[col].unique()
-                    # print(unique_value)
-                    value = ""   ## Default value for no matching or "skip" gene.
-                    if not skip:
-                        if len(unique_value) > 1:
-                            print(f"{gene} has more than 1 value for {col}: {unique_value}")
-                            value = ';'.join(unique_value)
-                            # Write to file.
-                            output_file = mvalue_folder / f"{gene}.txt"
-                            df_gene.to_csv(output_file, sep='\t', index=False)
-                        else:
-                            ## If there's no matching value, the array is [nan] with dtype "float64".
-                            if not unique_value.dtype == "float64":
-                                value = unique_value[0]
-                            else:  # "float64" may contain nan
-                                if np.isnan(unique_value):
-                                    continue
-                                else:  # An float numeric other than nan.
-                                    value = unique_value[0]
-                    # print(dict_col[col])
-                    # print(value)
-                    df_test.loc[i, dict_col[col]] = value
-                    
-
-    # print(df_test)
-    
+    profiler = Profiler(trace_memory=profile_memory)
+    if backend == "datasets":
+        client = DatasetsClient(datasets_path, api_key, max_rps, max_retries,
+                                profiler=profiler)
+        cache = AnnotationCache(cache_file,
+                                ttl=cache_ttl_days * 86400,
+                                max_bytes=cache_max_mb * 1024 ** 2)
+        def lookup(genes):
+            return lookup_genes_cached(genes, input_type,
+                                       taxon, fields,
+                                       cache, refresh_cache,
+                                       batch_size=batch_size,
+                                       workers=workers,
+                                       client=client)
+    elif backend == "offline":
+        store = OfflineGeneStore(offline_store)
+        def lookup(genes):
+            return store.lookup(genes, input_type)
+    else:
+        print(f'Error: please check "backend".')
+        sys.exit()
+
+    if not go_text_columns:
+        dict_go = {}
+
+    def annotate_chunk(df):
+        return annotate_table(df, input_colname, input_type, lookup,
+                              match_method, dict_col, dict_go,
+                              side_store, profiler, go_matrix)
+
     if match_method == "all":
         output_name = f"{input_file.stem}_annotate.txt"
+        go_prefix = output_folder / input_file.stem
     else:
         output_name = f"{input_file.stem}_annotate_strict.txt"
+        go_prefix = output_folder / f"{input_file.stem}_strict"
     output_file = output_folder / output_name
-    df_test.to_csv(output_file, sep='\t', index=False)
-
-
-    # ## Single gene test.
-    # dataset_command = ["datasets", "summary", "gene", input_type]
-    # dataset_command.append("CTSO")
-    # command = dataset_command + fields_command
-    # ## Run the command and pass result to a DataFrame.
-    # # Execute the command and capture the output.
-    # result = subprocess.run(command, shell=True, capture_output=True, text=True)
-    # # print(type(result.stdout))
-    # # Check for errors.
-    # if result.returncode != 0:
-    #     print("Error:", result.stderr)
-    # else:
-    #     if result.stdout != "":
-    #         # Convert the tsv output to a Pandas DataFrame.
-    #         df_gene = pd.read_csv(io.StringIO(result.stdout), sep="\t")
-
-    #         # Display the DataFrame.
-    #         print(df_gene)
+    if chunk_size is None or read_journal(input_file, output_file,
+                                          verbose=False) is None:
+        ## A new run, drop the ambiguous genes and GO terms of earlier runs
+        ## so the reports count this input only.
+        for category in ["multiple_genes", "multiple_values", "go_pairs"]:
+            side_store.clear(category)
+
+    if chunk_size is None:
+        with profiler.stage("read"):
+            df = pd.read_table(input_file, sep='\t')
+        print(f"The shape of df: {df.shape}")
+        df, lookup_report = annotate_chunk(df)
+        with profiler.stage("write"):
+            df.to_csv(output_file, sep='\t', index=False)
+    else:
+        lookup_report = annotate_stream(input_file, output_file,
+                                        chunk_size, annotate_chunk, profiler)
+    print(f"Lookups saved: {lookup_report.get('lookups_saved', 0)} "
+          f"of {lookup_report.get('rows', 0)} rows")
+
+    if go_matrix:
+        with profiler.stage("go_matrix"):
+            build_go_matrix(side_store, go_prefix)
+    if backend == "datasets":
+        print(f"Retries: {client.retries}, not found: {len(client.not_found)}, "
+              f"failed: {text_color(len(client.failed), 'red' if client.failed else None)}")
+        if client.failed:
+            failed_file = output_folder / f"{input_file.stem}_failed.txt"
+            client.failed_report(input_colname).to_csv(failed_file, sep='\t',
+                                                       index=False)
+            print(f"Failed genes: {text_color(failed_file, 'yellow')}")
+        profiler.count("cache_hits", cache.hits)
+        profiler.count("cache_misses", cache.misses)
+        profiler.count("not_found", len(client.not_found))
+        profiler.count("failed", len(client.failed))
+        cache.close()
+    else:
+        store.close()
+    ## A gene can be in both categories.
+    n_ambiguous = len(set(side_store.genes("multiple_genes"))
+                      | set(side_store.genes("multiple_values")))
+    profiler.count("ambiguous_genes", n_ambiguous)
+    side_store.close()
+    if profile:
+        profile_file = output_folder / f"{output_file.stem}_profile.json"
+        profiler.write_report(profile_file, script="ncbi_data.py",
+                              input_file=input_file, backend=backend,
+                              batch_size=batch_size, workers=workers,
+                              chunk_size=chunk_size)
+        print(f"Run report: {text_color(profile_file, 'green')}")
 
 
     time_end = time()
@@ -0,0 +1,279 @@
+"""
+Offline gene annotation from the NCBI gene bulk files.
+
+Download from https://ftp.ncbi.nlm.nih.gov/gene/DATA/
+    gene_info.gz (or GENE_INFO/Mammalia/Homo_sapiens.gene_info.gz)
+    gene2go.gz
+    gene2refseq.gz (optional, for accession lookups, orientation and
+                    transcript/protein counts)
+"""
+import sqlite3
+from pathlib import Path
+from time import time, ctime
+import numpy as np
+import pandas as pd
+from utilities import text_color, show_time
+
+__author__ = "Johnathan Lin <jagonball@g-mail.nsysu.edu.tw>"
+__email__ = "jagonball@g-mail.nsysu.edu.tw"
+
+## Taxon names accepted besides the NCBI taxonomy ID.
+TAXON_ID = {"human": 9606, "mouse": 10090, "rat": 10116}
+
+## gene2go "Category" to the "dataformat" GO columns.
+GO_CATEGORY = {"Process": ("Gene Ontology Biological Process Go ID",
+                           "Gene Ontology Biological Process Name"),
+               "Component": ("Gene Ontology Cellular Component Go ID",
+                             "Gene Ontology Cellular Component Name"),
+               "Function": ("Gene Ontology Molecular Function Go ID",
+                            "Gene Ontology Molecular Function Name")}
+
+## gene2refseq "orientation" to the "dataformat" values.
+ORIENTATION = {"+": "plus", "-": "minus"}
+
+CHUNK_SIZE = 1000000
+
+
+def read_taxon(file_path, taxon_id, usecols):
+    """Read rows of one taxon from a NCBI gene bulk file in chunks.
+
+    :param file_path: Path to the (gzipped) tab-separated file.
+    :type file_path: str or Path
+    :param taxon_id: NCBI taxonomy ID.
+    :type taxon_id: int
+    :param usecols: Columns to keep, "#tax_id" is always read.
+    :type usecols: list
+    :return: Rows of the taxon, "-" is read as missing value except in
+        the "orientation" column.
+    :rtype: DataFrame
+    """
+    chunks = pd.read_table(file_path,
+                           usecols=["#tax_id"] + usecols,
+                           dtype=str,
+                           na_values={col: "-" for col in usecols
+                                      if col != "orientation"},
+                           keep_default_na=False,
+                           chunksize=CHUNK_SIZE)
+    df = pd.concat([chunk[chunk["#tax_id"] == str(taxon_id)]
+                    for chunk in chunks])
+    return df.drop(columns="#tax_id").reset_index(drop=True)
+
+
+def gene_table(df_genes, df_lists):
+    """Lay out genes like the "dataformat tsv gene" output.
+
+    Each gene takes as many rows as its longest list (at least one), list
+    values are placed from the first row of the gene and single values
+    are repeated on every row.
+
+    :param df_genes: One row for each gene, with "NCBI GeneID".
+    :type df_genes: DataFrame
+    :param df_lists: List values with "NCBI GeneID", one value per row
+        in the columns of that list.
+    :type df_lists: list of DataFrame
+    :return: The gene table.
+    :rtype: DataFrame
+    """
+    id_col = "NCBI GeneID"
+    ## Position of each value within its gene and list.
+    df_lists = [df.assign(pos=df.groupby(id_col).cumcount()) for df in df_lists]
+    n_rows = pd.concat([df.groupby(id_col)["pos"].max() + 1 for df in df_lists],
+                       axis=1).max(axis=1)
+    n_rows = n_rows.reindex(df_genes[id_col]).fillna(1).astype(int).to_numpy()
+    df_table = df_genes.loc[df_genes.index.repeat(n_rows)].reset_index(drop=True)
+    df_table["pos"] = np.arange(len(df_table)) - np.repeat(np.cumsum(n_rows) - n_rows,
+                                                           n_rows)
+    for df in df_lists:
+        df_table = df_table.merge(df, on=[id_col, "pos"], how="left")
+    return df_table.drop(columns="pos")
+
+
+def build_store(gene_info, gene2go, db_path, taxon="human", gene2refseq=None):
+    """Build the indexed local store from the NCBI gene bulk files.
+
+    :param gene_info: Path to "gene_info.gz".
+    :type gene_info: str or Path
+    :param gene2go: Path to "gene2go.gz".
+    :type gene2go: str or Path
+    :param db_path: Path to the SQLite store, replaced if exists.
+    :type db_path: str or Path
+    :param taxon: Taxon name or NCBI taxonomy ID, defaults to "human"
+    :type taxon: str or int, optional
+    :param gene2refseq: Path to "gene2refseq.gz", defaults to None
+    :type gene2refseq: str or Path, optional
+    """
+    id_col = "NCBI GeneID"
+    taxon_id = TAXON_ID.get(taxon, taxon)
+    df_info = read_taxon(gene_info, taxon_id,
+                         ["GeneID", "Symbol", "Synonyms",
+                          "description", "type_of_gene"])
+    df_genes = pd.DataFrame({
+        id_col: df_info["GeneID"].astype(int),
+        "Symbol": df_info["Symbol"],
+        ## One value joined by ",", as in the "dataformat" output.
+        "Synonyms": df_info["Synonyms"].str.replace("|", ",", regex=False),
+        "Description": df_info["description"],
+        "Gene Type": df_info["type_of_gene"].str.upper().str.replace("-", "_")})
+    print(f"Genes of taxon {taxon_id}: {len(df_genes)}")
+
+    ## Synonyms, one per row for the lookup keys.
+    df_syn = pd.DataFrame({id_col: df_genes[id_col],
+                           "Synonyms": df_info["Synonyms"].str.split("|")})
+    df_syn = df_syn.explode("Synonyms").dropna()
+
+    ## GO terms, one list for each category.
+    df_go = read_taxon(gene2go, taxon_id,
+                       ["GeneID", "GO_ID", "GO_term", "Category"])
+    df_go = df_go.drop_duplicates(["GeneID", "GO_ID"])
+    df_go[id_col] = df_go["GeneID"].astype(int)
+    df_lists = []
+    for category, (id_name, term_name) in GO_CATEGORY.items():
+        df_cat = df_go[df_go["Category"] == category]
+        df_lists.append(df_cat[[id_col, "GO_ID", "GO_term"]].rename(
+            columns={"GO_ID": id_name, "GO_term": term_name}))
+    print(f"GO annotations: {len(df_go)}")
+
+    ## Lookup keys: symbols, synonyms (used only when no symbol matches),
+    ## gene IDs, accessions.
+    list_keys = [pd.DataFrame({"key": df_genes["Symbol"].str.upper(),
+                               "key_type": "symbol",
+                               "gene_id": df_genes[id_col]}),
+                 pd.DataFrame({"key": df_syn["Synonyms"].str.upper(),
+                               "key_type": "synonym",
+                               "gene_id": df_syn[id_col]}),
+                 pd.DataFrame({"key": df_genes[id_col].astype(str),
+                               "key_type": "gene-id",
+                               "gene_id": df_genes[id_col]})]
+
+    if gene2refseq is not None:
+        df_ref = read_taxon(gene2refseq, taxon_id,
+                            ["GeneID",
+                             "RNA_nucleotide_accession.version",
+                             "protein_accession.version",
+                             "orientation"])
+        df_ref["gene_id"] = df_ref["GeneID"].astype(int)
+        df_ref["Orientation"] = df_ref["orientation"].map(ORIENTATION)
+        df_genes = df_genes.merge(
+            df_ref.groupby("gene_id").agg(
+                Orientation=("Orientation", "first"),
+                Transcripts=("RNA_nucleotide_accession.version", "nunique"),
+                Proteins=("protein_accession.version", "nunique")),
+            left_on=id_col, right_index=True, how="left")
+        df_genes[["Transcripts", "Proteins"]] = df_genes[
+            ["Transcripts", "Proteins"]].astype("Int64")
+        for col in ["RNA_nucleotide_accession.version",
+                    "protein_accession.version"]:
+            df_acc = df_ref[["gene_id", col]].dropna().drop_duplicates()
+            accession = df_acc[col].str.upper()
+            for key in [accession, accession.str.split(".").str[0]]:
+                list_keys.append(pd.DataFrame({"key": key,
+                                               "key_type": "accession",
+                                               "gene_id": df_acc["gene_id"]}))
+    else:
+        df_genes = df_genes.assign(Orientation=np.nan,
+                                   Transcripts=np.nan,
+                                   Proteins=np.nan)
+
+    df_table = gene_table(df_genes, df_lists)
+    df_keys = pd.concat(list_keys).dropna().drop_duplicates()
+
+    db_path = Path(db_path)
+    if db_path.exists():
+        db_path.unlink()
+    with sqlite3.connect(db_path) as conn:
+        df_table.to_sql("gene_rows", conn, index=False)
+        df_keys.to_sql("gene_keys", conn, index=False)
+        conn.execute('CREATE INDEX idx_gene_rows ON gene_rows ("NCBI GeneID")')
+        conn.execute("CREATE INDEX idx_gene_keys ON gene_keys (key_type, key)")
+    print(f"Store written: {text_color(db_path, 'green')}")
+
+
+class OfflineGeneStore:
+    """Look up genes from a store built by "build_store".
+
+    :param db_path: Path to the SQLite store.
+    :type db_path: str or Path
+    """
+    ## Max number of "?" in one query, below the SQLite limit.
+    chunk_size = 500
+
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path)
+
+    @staticmethod
+    def normalize(gene, input_type):
+        """Normalize an identifier to its key in the store."""
+        gene = gene.strip().upper()
+        if input_type == "accession":
+            gene = gene.split(".")[0]
+        return gene
+
+    def lookup(self, genes, input_type):
+        """Look up genes by symbol, gene ID or accession. A symbol that is
+        no gene's official symbol is looked up in the synonyms, as in
+        "split_gene_results" of "ncbi_data.py".
+
+        :param genes: Genes to look up.
+        :type genes: list
+        :param input_type: "symbol", "gene-id" or "accession".
+        :type input_type: str
+        :return: Result DataFrame of each gene, same columns as the
+            "dataformat tsv gene" output.
+        :rtype: dict
+        """
+        genes = list(dict.fromkeys(str(gene) for gene in genes))
+        dict_key = {gene: self.normalize(gene, input_type) for gene in genes}
+        keys = list(dict.fromkeys(dict_key.values()))
+        key_types = [input_type] + (["synonym"] if input_type == "symbol" else [])
+        list_df = []
+        for start in range(0, len(keys), self.chunk_size):
+            chunk = keys[start:start + self.chunk_size]
+            placeholders = ",".join("?" * len(chunk))
+            types = ",".join("?" * len(key_types))
+            list_df.append(pd.read_sql(
+                f"""SELECT k.key AS query_key, k.key_type AS query_type, r.*
+                    FROM gene_keys k
+                    JOIN gene_rows r ON r."NCBI GeneID" = k.gene_id
+                    WHERE k.key_type IN ({types}) AND k.key IN ({placeholders})
+                    ORDER BY k.key, r.rowid""",
+                self.conn, params=key_types + chunk))
+        df_rows = pd.concat(list_df) if list_df else pd.DataFrame()
+        if not df_rows.empty:
+            ## An official symbol takes precedence over the synonyms.
+            official = df_rows.loc[df_rows["query_type"] == input_type,
+                                   "query_key"]
+            df_rows = df_rows[(df_rows["query_type"] == input_type)
+                              | ~df_rows["query_key"].isin(official)]
+        df_rows = df_rows.drop(columns="query_type", errors="ignore")
+        if df_rows.empty:
+            empty = df_rows.drop(columns="query_key", errors="ignore")
+            return {gene: empty for gene in genes}
+        dict_rows = {key: df.drop(columns="query_key").reset_index(drop=True)
+                     for key, df in df_rows.groupby("query_key", sort=False)}
+        empty = df_rows.iloc[0:0].drop(columns="query_key")
+        return {gene: dict_rows.get(dict_key[gene], empty) for gene in genes}
+
+    def close(self):
+        self.conn.close()
+
+
+def main():
+    time_start = time()
+    print(f"ncbi_offline.py start time: {ctime(time_start)}")
+
+    data_folder = Path("D:/Repositories/ncbi_gene")
+    gene_info = data_folder / "Homo_sapiens.gene_info.gz"
+    gene2go = data_folder / "gene2go.gz"
+    gene2refseq = data_folder / "gene2refseq.gz"  # None to skip.
+    taxon = "human"
+    db_path = data_folder / f"ncbi_gene_{taxon}.sqlite"
+
+    build_store(gene_info, gene2go, db_path, taxon, gene2refseq)
+
+    time_end = time()
+    time_used = time_end - time_start
+    show_time(time_used, "Total time taken")
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,231 @@
+"""
+Normalization of probe x sample microarray intensity matrices.
+
+Every method works column by column in place, so the same code runs on an
+in-memory array or on a column-major memory-mapped file for matrices that
+do not fit in RAM.
+"""
+from pathlib import Path
+from time import time, ctime
+import numpy as np
+import pandas as pd
+from utilities import read_df, show_time, text_color
+
+__author__ = "Johnathan Lin <jagonball@g-mail.nsysu.edu.tw>"
+__email__ = "jagonball@g-mail.nsysu.edu.tw"
+
+
+def background_correct(matrix, percentile=5, floor=1.0):
+    """Subtract the background of each sample, estimated as a low
+    percentile of its intensities, and raise values below "floor".
+
+    :param matrix: Probe x sample intensities, modified in place.
+    :type matrix: ndarray or memmap
+    :param percentile: Percentile taken as the background, defaults to 5
+    :type percentile: float, optional
+    :param floor: Minimum corrected intensity, defaults to 1.0
+    :type floor: float, optional
+    :return: The background of each sample.
+    :rtype: ndarray
+    """
+    backgrounds = np.empty(matrix.shape[1])
+    for j in range(matrix.shape[1]):
+        column = matrix[:, j]
+        backgrounds[j] = np.nanpercentile(column, percentile)
+        np.maximum(column - backgrounds[j], floor, out=column)
+        matrix[:, j] = column
+    return backgrounds
+
+
+def log2_transform(matrix, offset=1.0):
+    """Log2 transform intensities, log2(x + offset).
+
+    :param matrix: Probe x sample intensities, modified in place.
+    :type matrix: ndarray or memmap
+    :param offset: Added before the log to keep zeros finite, defaults to 1.0
+    :type offset: float, optional
+    """
+    for j in range(matrix.shape[1]):
+        column = matrix[:, j]
+        np.log2(column + offset, out=column)
+        matrix[:, j] = column
+
+
+def median_scale(matrix, log_scale=True):
+    """Scale every sample to the mean of the sample medians.
+
+    :param matrix: Probe x sample intensities, modified in place.
+    :type matrix: ndarray or memmap
+    :param log_scale: The values are logged (shift by the difference) or
+        linear (multiply by the ratio), defaults to True
+    :type log_scale: bool, optional
+    :return: The median of each sample before scaling.
+    :rtype: ndarray
+    """
+    medians = np.array([np.nanmedian(matrix[:, j])
+                        for j in range(matrix.shape[1])])
+    target = medians.mean()
+    for j in range(matrix.shape[1]):
+        if log_scale:
+            matrix[:, j] += target - medians[j]
+        else:
+            matrix[:, j] *= target / medians[j]
+    return medians
+
+
+def quantile_normalize(matrix):
+    """Give every sample the same distribution, the mean of the sorted
+    samples. Missing values stay missing, a sample with missing values is
+    mapped onto the reference by its quantiles.
+
+    :param matrix: Probe x sample intensities, modified in place.
+    :type matrix: ndarray or memmap
+    :return: The reference distribution, sorted.
+    :rtype: ndarray
+    """
+    n_rows, n_cols = matrix.shape
+    grid = np.linspace(0, 1, n_rows)
+    ## First pass: the mean of the sorted samples.
+    reference = np.zeros(n_rows)
+    for j in range(n_cols):
+        values = np.sort(matrix[:, j])
+        values = values[~np.isnan(values)]
+        if len(values) < n_rows:
+            values = np.interp(grid, np.linspace(0, 1, len(values)), values)
+        reference += values
+    reference /= n_cols
+    ## Second pass: replace each value by the reference at its rank.
+    for j in range(n_cols):
+        column = matrix[:, j]
+        valid = ~np.isnan(column)
+        n_valid = int(valid.sum())
+        order = np.argsort(column, kind="stable")[:n_valid]
+        if n_valid == n_rows:
+            column[order] = reference
+        else:
+            column[order] = np.interp(np.linspace(0, 1, n_valid), grid, reference)
+        matrix[:, j] = column
+    return reference
+
+
+## Methods by name, applied in the listed order.
+METHODS = {"background": background_correct,
+           "log2": log2_transform,
+           "median": median_scale,
+           "quantile": quantile_normalize}
+
+
+def normalize(matrix, methods):
+    """Apply normalization methods in order.
+
+    :param matrix: Probe x sample intensities, modified in place.
+    :type matrix: ndarray or memmap
+    :param methods: Method names, ex: ["background", "log2", "quantile"].
+    :type methods: list
+    """
+    for method in methods:
+        print(f"Normalizing: {text_color(method, 'cyan')}")
+        METHODS[method](matrix)
+
+
+def read_matrix(input_file, id_cols, sample_cols=None, memmap_file=None,
+                chunksize=100000):
+    """Read the probe annotation columns and the intensity matrix.
+
+    :param input_file: Path to the probe x sample table.
+    :type input_file: Path
+    :param id_cols: Probe annotation columns kept as is.
+    :type id_cols: list
+    :param sample_cols: Intensity columns, defaults to None (all the other
+        numeric columns)
+    :type sample_cols: list, optional
+    :param memmap_file: Column-major float32 file for the matrix, defaults
+        to None (in memory)
+    :type memmap_file: Path, optional
+    :param chunksize: Rows read at a time for "memmap_file", defaults to 100000
+    :type chunksize: int, optional
+    :return: The annotation columns, the sample names and the matrix.
+    :rtype: tuple(DataFrame, list, ndarray or memmap)
+    """
+    if memmap_file is None:
+        df = read_df(input_file)
+        if sample_cols is None:
+            sample_cols = [col for col in df.select_dtypes("number").columns
+                           if col not in id_cols]
+        matrix = np.asfortranarray(df[sample_cols].to_numpy(dtype=np.float32))
+        return df[id_cols], sample_cols, matrix
+
+    ## First pass: annotation columns and the number of rows.
+    list_ids = []
+    for chunk in read_df(input_file, chunksize=chunksize):
+        if sample_cols is None:
+            sample_cols = [col for col in chunk.select_dtypes("number").columns
+                           if col not in id_cols]
+        list_ids.append(chunk[id_cols])
+    df_ids = pd.concat(list_ids, ignore_index=True)
+    ## Second pass: fill the memory-mapped matrix.
+    matrix = np.lib.format.open_memmap(memmap_file, mode="w+",
+                                       dtype=np.float32,
+                                       shape=(len(df_ids), len(sample_cols)),
+                                       fortran_order=True)
+    start = 0
+    for chunk in read_df(input_file, chunksize=chunksize, usecols=sample_cols):
+        matrix[start:start + len(chunk)] = chunk[sample_cols].to_numpy(np.float32)
+        start += len(chunk)
+    matrix.flush()
+    return df_ids, sample_cols, matrix
+
+
+def write_matrix(output_file, df_ids, sample_cols, matrix, chunksize=100000):
+    """Write the normalized table, tab-separated as "data_migrate.py".
+
+    :param output_file: Path to the output file.
+    :type output_file: Path
+    :param df_ids: The probe annotation columns.
+    :type df_ids: DataFrame
+    :param sample_cols: The sample names.
+    :type sample_cols: list
+    :param matrix: Probe x sample intensities.
+    :type matrix: ndarray or memmap
+    :param chunksize: Rows written at a time, defaults to 100000
+    :type chunksize: int, optional
+    """
+    with open(output_file, "w", newline="", encoding="utf-8") as f:
+        for start in range(0, max(len(df_ids), 1), chunksize):
+            df_chunk = df_ids.iloc[start:start + chunksize].reset_index(drop=True)
+            df_values = pd.DataFrame(matrix[start:start + chunksize],
+                                     columns=sample_cols)
+            pd.concat([df_chunk, df_values], axis=1).to_csv(
+                f, sep='\t', index=False, header=start == 0)
+
+
+def main():
+    time_start = time()
+    print(f"normalization.py start time: {ctime(time_start)}")
+
+    input_file = Path("D:/Repositories/25_01_Liver_Cancer/data/Microarray_Huh7_raw.txt")
+    output_folder = Path("D:/Repositories/25_01_Liver_Cancer/data")
+    output_file = output_folder / "Microarray_Huh7_normalized.txt"
+    # Probe annotation columns, kept as is.
+    id_cols = ["ProbeName", "symbol"]
+    # Intensity columns, None for all the other numeric columns.
+    sample_cols = None
+    # Applied in order: "background", "log2", "median", "quantile".
+    methods = ["background", "log2", "quantile"]
+    # Memory-mapped matrix file for matrices larger than RAM, None for in memory.
+    memmap_file = None  # output_folder / "Microarray_Huh7_matrix.npy"
+
+    df_ids, sample_cols, matrix = read_matrix(input_file, id_cols,
+                                              sample_cols, memmap_file)
+    print(f"Matrix: {matrix.shape[0]} probes x {matrix.shape[1]} samples")
+    normalize(matrix, methods)
+    write_matrix(output_file, df_ids, sample_cols, matrix)
+    print(f"Output: {text_color(output_file, 'green')}")
+
+    time_end = time()
+    time_used = time_end - time_start
+    show_time(time_used, "Total time taken")
+
+
+if __name__=="__main__":
+    main()
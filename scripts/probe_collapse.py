@@ -0,0 +1,125 @@
+"""
+Collapse the probes of a microarray table to one row per gene.
+"""
+from pathlib import Path
+from time import time, ctime
+import sys
+import numpy as np
+import pandas as pd
+from utilities import read_df, show_time, text_color
+
+__author__ = "Johnathan Lin <jagonball@g-mail.nsysu.edu.tw>"
+__email__ = "jagonball@g-mail.nsysu.edu.tw"
+
+## Collapse methods, the probe picked or how the probes are combined.
+METHODS = ["max-mean", "max-var", "first", "median"]
+
+
+def collapse_probes(df, key_col, value_cols, method="max-mean", probe_col=None):
+    """Collapse the probes of each gene in one sort over integer-coded keys.
+    "max-mean" and "max-var" keep the probe with the highest mean or
+    variance of "value_cols", "first" keeps the first probe, "median"
+    takes the median of every value column over the probes. Probes without
+    a key are left out.
+
+    :param df: Probe table.
+    :type df: DataFrame
+    :param key_col: Gene column to group by, ex: "symbol" or "GeneID".
+    :type key_col: str
+    :param value_cols: Expression columns.
+    :type value_cols: list
+    :param method: One of METHODS, defaults to "max-mean"
+    :type method: str, optional
+    :param probe_col: Probe ID column of the mapping table, defaults to
+        None (row number)
+    :type probe_col: str, optional
+    :return: One row per gene, in order of first appearance, and the
+        probe to gene mapping with the number of probes of the gene and
+        whether the probe was kept.
+    :rtype: tuple(DataFrame, DataFrame)
+    """
+    if method not in METHODS:
+        print(f"Collapse method {text_color(method, 'red')} not in {METHODS}")
+        sys.exit()
+    codes, _ = pd.factorize(df[key_col])
+    keyed = np.flatnonzero(codes >= 0)
+    codes_keyed = codes[keyed]
+    values = df[value_cols].to_numpy(dtype=float)[keyed]
+
+    ## Sort by gene code (order of first appearance), then by descending
+    ## score, the first row of each gene wins.
+    if method == "max-mean":
+        score = -np.nanmean(values, axis=1)
+    elif method == "max-var":
+        score = -np.nanvar(values, axis=1, ddof=1)
+    else:
+        score = np.zeros(len(keyed))
+    order = np.lexsort((score, codes_keyed))
+    codes_sorted = codes_keyed[order]
+    first = np.r_[True, codes_sorted[1:] != codes_sorted[:-1]]
+    picked = keyed[order[first]]
+    n_probes = np.bincount(codes_keyed)
+
+    df_gene = df.iloc[picked].reset_index(drop=True)
+    if method == "median":
+        starts = np.flatnonzero(first)
+        sorted_values = values[order]
+        medians = np.empty((len(starts), len(value_cols)))
+        ## Medians of equal-sized genes together, as one array per size.
+        sizes = np.diff(np.r_[starts, len(order)])
+        for size in np.unique(sizes):
+            groups = np.flatnonzero(sizes == size)
+            rows = starts[groups][:, None] + np.arange(size)
+            medians[groups] = np.nanmedian(sorted_values[rows], axis=1)
+        df_gene[value_cols] = medians
+        selected = np.ones(len(keyed), dtype=bool)
+    else:
+        selected = np.zeros(len(df), dtype=bool)
+        selected[picked] = True
+        selected = selected[keyed]
+    df_gene.insert(df_gene.columns.get_loc(key_col) + 1, "Probe_Count",
+                   n_probes)
+
+    probes = df[probe_col].to_numpy()[keyed] if probe_col else keyed
+    df_map = pd.DataFrame({probe_col or "Row": probes,
+                           key_col: df[key_col].to_numpy()[keyed],
+                           "Probe_Count": n_probes[codes_keyed],
+                           "Selected": selected})
+    return df_gene, df_map
+
+
+def main():
+    time_start = time()
+    print(f"probe_collapse.py start time: {ctime(time_start)}")
+
+    input_file = Path("D:/Repositories/25_01_Liver_Cancer/data/Microarray_Huh7_normalized.txt")
+    output_folder = Path("D:/Repositories/25_01_Liver_Cancer/data")
+    probe_col = "ProbeName"
+    # Gene column, the "input_colname" of "ncbi_data.py".
+    key_col = "symbol"
+    # Expression columns, None for all the other numeric columns.
+    value_cols = None
+    # "max-mean", "max-var", "first" or "median".
+    method = "max-mean"
+
+    df = read_df(input_file, compact=True)
+    if value_cols is None:
+        value_cols = [col for col in df.select_dtypes("number").columns
+                      if col not in (probe_col, key_col)]
+    df_gene, df_map = collapse_probes(df, key_col, value_cols, method, probe_col)
+    print(f"Probes: {len(df_map)} of {len(df)} with a {key_col}, "
+          f"genes: {text_color(len(df_gene), 'green')}")
+
+    output_file = output_folder / f"{input_file.stem}_collapsed.txt"
+    df_gene.to_csv(output_file, sep='\t', index=False)
+    df_map.to_csv(output_folder / f"{input_file.stem}_probe_map.txt",
+                  sep='\t', index=False)
+    print(f"Output: {text_color(output_file, 'green')}")
+
+    time_end = time()
+    time_used = time_end - time_start
+    show_time(time_used, "Total time taken")
+
+
+if __name__=="__main__":
+    main()
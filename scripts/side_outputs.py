@@ -0,0 +1,209 @@
+"""
+Single SQLite store of the "ncbi_data.py" diagnostics: the result rows of
+each gene and the rows of genes with more than one match or value.
+"""
+import io
+import sqlite3
+from pathlib import Path
+from time import time, ctime
+import numpy as np
+import pandas as pd
+from utilities import show_time, text_color
+
+__author__ = "Johnathan Lin <jagonball@g-mail.nsysu.edu.tw>"
+__email__ = "jagonball@g-mail.nsysu.edu.tw"
+
+## Categories of the store, in place of the folders "temp_gene_results",
+## "multiple_genes" and "multiple_values", and the GO terms of each gene
+## for the GO matrix.
+CATEGORIES = ["gene_results", "multiple_genes", "multiple_values", "go_pairs"]
+
+
+class SideOutputStore:
+    """SQLite table of the result rows of each gene and category, stored
+    as the tsv text of the former "<gene>.txt" files. Each "write" is one
+    transaction, a gene written again replaces its rows.
+
+    :param db_path: Path to the SQLite file, created if not exist.
+    :type db_path: str or Path
+    """
+    ## Max number of "?" in one query, below the SQLite limit.
+    chunk_size = 500
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS side_outputs (
+                                 category TEXT,
+                                 gene TEXT,
+                                 n_rows INTEGER,
+                                 data TEXT,
+                                 written REAL,
+                                 PRIMARY KEY (category, gene))""")
+        self.conn.commit()
+
+    def write(self, category, df_long, replace=True):
+        """Store the rows of each gene in one batch.
+
+        :param category: One of CATEGORIES.
+        :type category: str
+        :param df_long: Rows of the genes, with a "Query" column.
+        :type df_long: DataFrame
+        :param replace: Replace the rows of genes already stored, or keep
+            them and their order, defaults to True
+        :type replace: bool, optional
+        """
+        now = time()
+        df_long = df_long.reset_index(drop=True)
+        codes, genes = pd.factorize(df_long["Query"])
+        order = np.argsort(codes, kind="stable")
+        df_data = df_long.drop(columns="Query").iloc[order]
+        ## Format all rows in one call, then cut the lines by gene.
+        header = "\t".join(map(str, df_data.columns)) + "\n"
+        lines = df_data.to_csv(sep="\t", index=False, header=False,
+                               lineterminator="\n").splitlines(keepends=True)
+        bounds = np.r_[0, np.cumsum(np.bincount(codes, minlength=len(genes)))]
+        if len(lines) != len(df_data):  # Values with line breaks.
+            lines = [df_data.iloc[[i]].to_csv(sep="\t", index=False,
+                                              header=False, lineterminator="\n")
+                     for i in range(len(df_data))]
+        rows = [(category, str(gene), int(bounds[i + 1] - bounds[i]),
+                 header + "".join(lines[bounds[i]:bounds[i + 1]]), now)
+                for i, gene in enumerate(genes)]
+        conflict = "REPLACE" if replace else "IGNORE"
+        self.conn.executemany(f"""INSERT OR {conflict} INTO side_outputs
+                                  VALUES (?, ?, ?, ?, ?)""", rows)
+        self.conn.commit()
+
+    def write_results(self, gene_results):
+        """Store the non-empty result of each gene as "gene_results".
+
+        :param gene_results: Result DataFrame of each gene.
+        :type gene_results: dict
+        """
+        gene_results = {gene: df for gene, df in gene_results.items()
+                        if not df.empty}
+        if gene_results:
+            df_long = pd.concat(gene_results, names=["Query", None])
+            self.write("gene_results", df_long.reset_index(level=0))
+
+    def genes(self, category):
+        """The genes stored in a category, in order of writing.
+
+        :rtype: list
+        """
+        rows = self.conn.execute("""SELECT gene FROM side_outputs
+                                    WHERE category = ? ORDER BY rowid""",
+                                 (category,)).fetchall()
+        return [gene for gene, in rows]
+
+    def read(self, category, genes=None):
+        """Read the rows of a category.
+
+        :param category: One of CATEGORIES.
+        :type category: str
+        :param genes: Genes to read, defaults to None (all genes)
+        :type genes: list, optional
+        :return: The rows of the genes, with a "Query" column first.
+        :rtype: DataFrame
+        """
+        if genes is None:
+            rows = self.conn.execute("""SELECT gene, n_rows, data FROM side_outputs
+                                        WHERE category = ? ORDER BY rowid""",
+                                     (category,)).fetchall()
+        else:
+            genes = [str(gene) for gene in dict.fromkeys(genes)]
+            rows = []
+            for start in range(0, len(genes), self.chunk_size):
+                chunk = genes[start:start + self.chunk_size]
+                placeholders = ",".join("?" * len(chunk))
+                rows += self.conn.execute(
+                    f"""SELECT gene, n_rows, data FROM side_outputs
+                        WHERE category = ? AND gene IN ({placeholders})
+                        ORDER BY rowid""", [category] + chunk).fetchall()
+        ## Parse the genes with the same columns in one call.
+        groups = {}
+        for gene, n_rows, data in rows:
+            header, _, body = data.partition("\n")
+            groups.setdefault(header, []).append((gene, n_rows, body))
+        list_df = []
+        for header, group in groups.items():
+            genes, n_rows, bodies = zip(*group)
+            df = pd.read_csv(io.StringIO(header + "\n" + "".join(bodies)),
+                             sep="\t")
+            if len(df) == sum(n_rows):
+                list_df.append(df.assign(Query=np.repeat(genes, n_rows)))
+            else:  # Blank lines of empty rows, parse each gene.
+                list_df += [pd.read_csv(io.StringIO(header + "\n" + body),
+                                        sep="\t").assign(Query=gene)
+                            for gene, _, body in group]
+        if not list_df:
+            return pd.DataFrame(columns=["Query"])
+        df = pd.concat(list_df, ignore_index=True)
+        return df[["Query"] + [col for col in df.columns if col != "Query"]]
+
+    def clear(self, category):
+        """Remove all genes of a category.
+
+        :param category: One of CATEGORIES.
+        :type category: str
+        """
+        self.conn.execute("DELETE FROM side_outputs WHERE category = ?",
+                          (category,))
+        self.conn.commit()
+
+    def ambiguous_genes(self):
+        """Report of the genes with more than one matched symbol or more
+        than one value of an annotated column.
+
+        :return: Columns "Query", "Category", "Rows" and "Symbols" (the
+            matched symbols joined by ";").
+        :rtype: DataFrame
+        """
+        list_report = []
+        for category in ["multiple_genes", "multiple_values"]:
+            df = self.read(category)
+            if df.empty:
+                continue
+            df_report = df.groupby("Query", sort=False).agg(
+                Rows=("Query", "size"),
+                Symbols=("Symbol", lambda x: ";".join(x.dropna().astype(str)
+                                                      .unique())))
+            list_report.append(df_report.reset_index()
+                               .assign(Category=category))
+        if not list_report:
+            return pd.DataFrame(columns=["Query", "Category", "Rows", "Symbols"])
+        df_report = pd.concat(list_report, ignore_index=True)
+        return df_report[["Query", "Category", "Rows", "Symbols"]]
+
+    def close(self):
+        self.conn.close()
+
+
+def main():
+    time_start = time()
+    print(f"side_outputs.py start time: {ctime(time_start)}")
+
+    ## Store written by "ncbi_data.py" in the project folder.
+    db_path = Path("C:/Users/CSBM_JL/OneDrive/Documents/[精準醫學博士班]/250423_Irisin_RNAeq/data_analysis/annotate/antiI10_IgG/side_outputs.sqlite")
+    output_folder = db_path.parent
+    # Also export the rows of the ambiguous genes.
+    export_rows = True
+
+    store = SideOutputStore(db_path)
+    df_report = store.ambiguous_genes()
+    print(f"Ambiguous genes: {text_color(df_report['Query'].nunique(), 'yellow')}")
+    df_report.to_csv(output_folder / "ambiguous_genes.txt", sep='\t', index=False)
+    if export_rows:
+        for category in ["multiple_genes", "multiple_values"]:
+            store.read(category).to_csv(output_folder / f"{category}.txt",
+                                        sep='\t', index=False)
+    store.close()
+
+    time_end = time()
+    time_used = time_end - time_start
+    show_time(time_used, "Total time taken")
+
+
+if __name__=="__main__":
+    main()
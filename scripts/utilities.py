@@ -3,10 +3,31 @@ Some useful utilities.
 """
 import os
 import sys
+import json
+import hashlib
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
 from glob import glob
 from pathlib import Path
+import numpy as np
 import pandas as pd
-from time import strftime, gmtime
+from time import strftime, gmtime, perf_counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+try:  # Optional, for the columnar cache of "read_df".
+    import pyarrow as pa
+    from pyarrow import feather
+except ImportError:
+    pa = None
+try:  # Not on Windows, for the peak resident memory of "Profiler".
+    import resource
+except ImportError:
+    resource = None
+try:  # Optional, for the peak memory of "Profiler" on Windows.
+    import psutil
+except ImportError:
+    psutil = None
 
 __author__ = "Johnathan Lin <jagonball@g-mail.nsysu.edu.tw>"
 __email__ = "jagonball@g-mail.nsysu.edu.tw"
@@ -169,9 +190,23 @@ def read_df(file_path,
             delimiter='\t',
             header=0,
             index_col=None,
-            usecols=None):
+            usecols=None,
+            cache_dir=None,
+            compact=False,
+            category_max_ratio=0.5,
+            chunksize=None):
     """Read data matrix with Pandas, accept csv, tsv, or excel.
 
+    With "cache_dir", the table is converted once to an Arrow IPC (Feather)
+    file keyed by the file path, modified time, sheet and read options,
+    later reads load the cached file instead of parsing the input. Caches
+    of earlier versions of the file are removed. Needs "pyarrow".
+
+    With "compact", repeated string columns are read as category and float
+    columns as float32 (see "compact_df"), text files are parsed by the
+    "pyarrow" engine if installed, or in chunks of "chunksize" rows so only
+    one chunk is held at full size.
+
     :param file_path: Path to the file
     :type file_path: str or Path
     :param sheet_name: Strings are used for sheet names. Integers are used in zero-indexed sheet positions, defaults to 0
@@ -184,10 +219,36 @@ def read_df(file_path,
     :type index_col: Hashable, Sequence of Hashable or False, optional
     :param usecols: Subset of columns to select, denoted either by column labels or column indices, defaults to None
     :type usecols: Sequence of Hashable or Callable, optional
-    :return: The DataFrame
-    :rtype: DataFrame
+    :param cache_dir: Folder of the columnar cache, defaults to None (no cache)
+    :type cache_dir: str or Path, optional
+    :param compact: Read with memory-lean dtypes, defaults to False
+    :type compact: bool, optional
+    :param category_max_ratio: Max unique/total ratio of a string column read as category, defaults to 0.5
+    :type category_max_ratio: float, optional
+    :param chunksize: Rows to parse at a time for text files, the chunks are concatenated with "compact", otherwise an iterator of chunks is returned, defaults to None
+    :type chunksize: int, optional
+    :return: The DataFrame, or an iterator of DataFrame chunks
+    :rtype: DataFrame or TextFileReader
     """
     file_path = Path(file_path)
+    if chunksize and not compact:
+        return pd.read_table(file_path,
+                             sep=delimiter,
+                             header=header,
+                             index_col=index_col,
+                             usecols=usecols,
+                             chunksize=chunksize)
+    cache_file = None
+    if cache_dir is not None:
+        if pa is None:
+            print(f'{text_color("Warning", "bright_yellow")}: '
+                  f'"pyarrow" is not installed, reading without cache.')
+        elif isinstance(sheet_name, (str, int)) and not callable(usecols):
+            cache_file = read_cache_path(file_path, cache_dir, sheet_name,
+                                         delimiter, header, index_col, usecols,
+                                         compact and category_max_ratio)
+            if cache_file.exists():
+                return feather.read_feather(cache_file)
     # Check suffix, read file accordingly.
     excel = ['.xls', '.xlsx', '.xlsm',
              '.xlsb', '.odf', '.ods', '.odt']
@@ -197,18 +258,204 @@ def read_df(file_path,
                            header=header,
                            index_col=index_col,
                            usecols=usecols)
+        if compact:
+            df = compact_df(df, category_max_ratio, verbose=True)
+    elif compact and chunksize:
+        reader = pd.read_table(file_path,
+                               sep=delimiter,
+                               header=header,
+                               index_col=index_col,
+                               usecols=usecols,
+                               chunksize=chunksize)
+        df = concat_compact(reader, category_max_ratio)
     else:
+        ## The "pyarrow" engine takes a single character delimiter only.
+        engine = None
+        if compact and pa is not None and len(delimiter) == 1 \
+                and not callable(usecols):
+            engine = "pyarrow"
         df = pd.read_table(file_path,
                            sep=delimiter,
                            header=header,
                            index_col=index_col,
-                           usecols=usecols)
+                           usecols=usecols,
+                           engine=engine)
+        if compact:
+            df = compact_df(df, category_max_ratio, verbose=True)
+    if cache_file is not None:
+        write_cache(df, cache_file)
     return df
 
 
-def df_cat_filter(df, col, condition, reset_index=True):
+def df_memory(df):
+    """Memory used by a DataFrame in MB, including the string contents."""
+    return df.memory_usage(deep=True).sum() / 1024 ** 2
+
+
+## Integers above this are not exact in float32.
+FLOAT32_MAX_INT = 2 ** 24
+
+
+def compact_df(df, category_max_ratio=0.5, category_cols=None, float_cols=None,
+               verbose=False):
+    """Convert columns to memory-lean dtypes.
+
+    String columns with few unique values (symbols, gene types, groups) are
+    converted to category, float64 columns (intensities) to float32.
+    Integer-valued float columns beyond the exact range of float32 (gene
+    IDs with missing values) are kept as float64.
+
+    :param df: Input DataFrame
+    :type df: DataFrame
+    :param category_max_ratio: Max unique/total ratio of a string column converted to category, defaults to 0.5
+    :type category_max_ratio: float, optional
+    :param category_cols: String columns to convert to category, defaults to None (decided by "category_max_ratio")
+    :type category_cols: list, optional
+    :param float_cols: Float64 columns to convert to float32, defaults to None (all but the integer-valued columns beyond 2**24)
+    :type float_cols: list, optional
+    :param verbose: Print the memory before and after, defaults to False
+    :type verbose: bool, optional
+    :return: The converted DataFrame
+    :rtype: DataFrame
+    """
+    if verbose:
+        memory_before = df_memory(df)
+    converted = {}
+    for col in df.columns:
+        values = df[col]
+        if values.dtype == "float64":
+            if float_cols is None:
+                finite = values[np.isfinite(values)]
+                to_float32 = not ((finite == finite.round()).all()
+                                  and (finite.abs() > FLOAT32_MAX_INT).any())
+            else:
+                to_float32 = col in float_cols
+            if to_float32:
+                converted[col] = values.astype("float32")
+        elif values.dtype == object or pd.api.types.is_string_dtype(values):
+            if category_cols is None:
+                to_category = values.nunique() <= category_max_ratio * len(values)
+            else:
+                to_category = col in category_cols
+            if to_category:
+                converted[col] = values.astype("category")
+    df = df.copy(deep=False)
+    for col, values in converted.items():
+        df[col] = values
+    if verbose:
+        memory_after = df_memory(df)
+        print(f"Memory: {memory_before:.1f} MB -> "
+              f"{text_color(f'{memory_after:.1f} MB', 'green')} "
+              f"(saved {memory_before - memory_after:.1f} MB)")
+    return df
+
+
+def concat_compact(chunks, category_max_ratio=0.5):
+    """Compact and concatenate DataFrame chunks, category columns are
+    decided by the first chunk and their categories are merged.
+
+    :param chunks: DataFrame chunks with the same columns.
+    :type chunks: Iterable of DataFrame
+    :param category_max_ratio: Max unique/total ratio of a string column converted to category, defaults to 0.5
+    :type category_max_ratio: float, optional
+    :return: The concatenated DataFrame
+    :rtype: DataFrame
+    """
+    list_df = []
+    memory_before = 0
+    category_cols = None
+    for chunk in chunks:
+        memory_before += df_memory(chunk)
+        if category_cols is None:
+            chunk = compact_df(chunk, category_max_ratio)
+            category_cols = [col for col in chunk.columns
+                             if isinstance(chunk[col].dtype, pd.CategoricalDtype)]
+        else:
+            chunk = compact_df(chunk, category_cols=category_cols)
+            ## A column without any value in this chunk is read as float64.
+            for col in category_cols:
+                if not isinstance(chunk[col].dtype, pd.CategoricalDtype):
+                    chunk[col] = chunk[col].astype("category")
+        list_df.append(chunk)
+    if not list_df:
+        return pd.DataFrame()
+    for col in category_cols:
+        ## Empty chunks have categories of another dtype, leave them out.
+        parts = [df[col] for df in list_df if len(df[col].cat.categories)]
+        categories = pd.api.types.union_categoricals(parts).categories
+        for df in list_df:
+            df[col] = pd.Categorical(df[col], categories=categories)
+    df = pd.concat(list_df)
+    memory_after = df_memory(df)
+    print(f"Memory: {memory_before:.1f} MB -> "
+          f"{text_color(f'{memory_after:.1f} MB', 'green')} "
+          f"(saved {memory_before - memory_after:.1f} MB)")
+    return df
+
+
+def read_cache_path(file_path,
+                    cache_dir,
+                    sheet_name,
+                    delimiter,
+                    header,
+                    index_col,
+                    usecols,
+                    compact=False):
+    """Path of the cached table, named "<stem>_<path>_<version>_<options>"
+    by digests of the file path, its size and modified time, and the read
+    options.
+
+    :return: Path to the ".feather" file in "cache_dir".
+    :rtype: Path
+    """
+    file_path = file_path.resolve()
+    stat = file_path.stat()
+    keys = [str(file_path),
+            (stat.st_size, stat.st_mtime_ns),
+            (sheet_name, delimiter, header, index_col,
+             None if usecols is None else list(usecols), compact)]
+    digests = [hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:8]
+               for key in keys]
+    return Path(cache_dir) / f"{file_path.stem}_{'_'.join(digests)}.feather"
+
+
+def write_cache(df, cache_file):
+    """Write a DataFrame to the columnar cache, replaced in one step so a
+    parallel reader never sees a half written file. Caches of other
+    versions of the same file are removed.
+
+    Tables with column names of mixed types or duplicated names are not
+    cached, Arrow would not read them back with the same names.
+
+    :param df: The DataFrame.
+    :type df: DataFrame
+    :param cache_file: Path to the ".feather" file.
+    :type cache_file: Path
+    """
+    if len({type(col) for col in df.columns}) > 1 or df.columns.has_duplicates:
+        return
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    temp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+    feather.write_feather(pa.Table.from_pandas(df), temp_file)
+    os.replace(temp_file, cache_file)
+    ## "<stem>_<path>_<version>_<options>", same path but other versions.
+    prefix, version, _ = cache_file.stem.rsplit("_", 2)
+    for stale_file in cache_file.parent.glob("*.feather"):
+        if stale_file.stem.startswith(f"{prefix}_") \
+                and stale_file.stem.rsplit("_", 2)[1] != version:
+            try:
+                stale_file.unlink()
+            except OSError:  # Open by another reader.
+                pass
+
+
+def df_cat_filter(df, col, condition, reset_index=True, index=None, output="copy"):
     """Filter category column with values.
 
+    For repeated filtering of the same table, pass a "CategoryIndex" of the
+    column, built once, to take the matching rows without scanning the
+    column again.
+
     :param df: Input DataFrame
     :type df: DataFrame
     :param col: The category column name
@@ -217,29 +464,248 @@ def df_cat_filter(df, col, condition, reset_index=True):
     :type condition: str, list
     :param reset_index: To reset index, defaults to True
     :type reset_index: bool, optional
-    :return: The filtered DataFrame
-    :rtype: DataFrame
+    :param index: Prebuilt index of "col", defaults to None
+    :type index: CategoryIndex, optional
+    :param output: "copy" for a copy, "frame" for the rows without an extra copy (a view if the rows are contiguous), "positions" for the row positions, defaults to "copy"
+    :type output: str, optional
+    :return: The filtered DataFrame, or the row positions
+    :rtype: DataFrame or ndarray
     """
-    if isinstance(condition, str):
-        if reset_index:
-            df_filtered = df[df[col] == condition].copy().reset_index(drop=True)
-        else:
-            df_filtered = df[df[col] == condition].copy()
-    elif isinstance(condition, list):
-        if reset_index:
-            df_filtered = df[df[col].isin(condition)].copy().reset_index(drop=True)
-        else:
-            df_filtered = df[df[col].isin(condition)].copy()
-    else:
+    if not isinstance(condition, (str, list)):
         print(f'{text_color("Error", "bright red")}: '
               f'the condition must be '
               f'{text_color("string", "green")} or '
               f'{text_color("list", "green")}, '
               f'the provided input is: {text_color(condition, "red")}')
         sys.exit()
+    if index is None and output == "copy":
+        if isinstance(condition, str):
+            mask = df[col] == condition
+        else:
+            mask = df[col].isin(condition)
+        if reset_index:
+            df_filtered = df[mask].copy().reset_index(drop=True)
+        else:
+            df_filtered = df[mask].copy()
+        return df_filtered
+    if index is None:
+        index = CategoryIndex(df, col)
+    return take_rows(df, index.positions(condition), reset_index, output)
+
+
+def df_multi_filter(df, conditions, indexes=None, reset_index=True, output="copy"):
+    """Filter rows matching all the column conditions.
+
+    :param df: Input DataFrame
+    :type df: DataFrame
+    :param conditions: Target value(s) to keep of each column, ex: {"group": ["A", "B"], "gene_type": "protein-coding"}
+    :type conditions: dict
+    :param indexes: "CategoryIndex" of each column, missing ones are built and added for the next call, defaults to None
+    :type indexes: dict, optional
+    :param reset_index: To reset index, defaults to True
+    :type reset_index: bool, optional
+    :param output: "copy", "frame" or "positions", see "df_cat_filter", defaults to "copy"
+    :type output: str, optional
+    :return: The filtered DataFrame, or the row positions
+    :rtype: DataFrame or ndarray
+    """
+    if indexes is None:
+        indexes = {}
+    positions = None
+    ## Start from the column with the fewest matching rows.
+    list_positions = []
+    for col, condition in conditions.items():
+        if col not in indexes:
+            indexes[col] = CategoryIndex(df, col)
+        list_positions.append(indexes[col].positions(condition))
+    for col_positions in sorted(list_positions, key=len):
+        if positions is None:
+            positions = col_positions
+        else:
+            positions = np.intersect1d(positions, col_positions,
+                                       assume_unique=True)
+    if positions is None:
+        positions = np.arange(len(df))
+    return take_rows(df, positions, reset_index, output)
+
+
+def take_rows(df, positions, reset_index=True, output="copy"):
+    """Take rows by sorted positions as a copy, a frame or the positions.
+
+    :param df: Input DataFrame
+    :type df: DataFrame
+    :param positions: Sorted row positions.
+    :type positions: ndarray
+    :param reset_index: To reset index, defaults to True
+    :type reset_index: bool, optional
+    :param output: "copy", "frame" or "positions", defaults to "copy"
+    :type output: str, optional
+    :return: The rows, or the row positions
+    :rtype: DataFrame or ndarray
+    """
+    if output == "positions":
+        return positions
+    if len(positions) and positions[-1] - positions[0] + 1 == len(positions):
+        ## Contiguous rows, a slice is a view.
+        df_filtered = df.iloc[positions[0]:positions[-1] + 1]
+    else:
+        df_filtered = df.take(positions)
+    if output == "copy":
+        df_filtered = df_filtered.copy()
+    if reset_index:
+        df_filtered = df_filtered.reset_index(drop=True)
     return df_filtered
 
 
+class CategoryIndex:
+    """Row positions of each value of a category column, built once for
+    repeated filtering. A filter then costs O(matching rows).
+
+    The index is tied to the DataFrame it was built from, rebuild it after
+    the rows of the DataFrame change.
+
+    :param df: Input DataFrame
+    :type df: DataFrame
+    :param col: The category column name
+    :type col: str
+    """
+    def __init__(self, df, col):
+        self.col = col
+        codes, categories = pd.factorize(df[col])
+        self.categories = pd.Index(categories)
+        ## Row positions grouped by value, sorted within each value.
+        self.order = np.argsort(codes, kind="stable")
+        counts = np.bincount(codes[codes >= 0], minlength=len(categories))
+        n_missing = int((codes < 0).sum())
+        self.starts = n_missing + np.concatenate([[0], np.cumsum(counts)[:-1]]) \
+            if len(counts) else np.array([], dtype=int)
+        self.counts = counts
+
+    def positions(self, condition):
+        """Sorted row positions with the value(s) of condition.
+
+        :param condition: Target value(s)
+        :type condition: str, list
+        :return: The row positions
+        :rtype: ndarray
+        """
+        values = [condition] if isinstance(condition, str) else condition
+        codes = self.categories.get_indexer(pd.Index(values).unique())
+        codes = codes[codes >= 0]
+        if len(codes) == 1:
+            start = self.starts[codes[0]]
+            return self.order[start:start + self.counts[codes[0]]]
+        return np.sort(np.concatenate(
+            [self.order[self.starts[code]:self.starts[code] + self.counts[code]]
+             for code in codes] + [np.array([], dtype=np.intp)]))
+
+
+def load_sample(file_path, id_col, value_cols=None, **read_kwargs):
+    """Read one sample file with "read_df", indexed by "id_col".
+
+    :param file_path: Path to the file.
+    :type file_path: str or Path
+    :param id_col: The probe ID column.
+    :type id_col: str
+    :param value_cols: Columns to keep, defaults to None (all the others)
+    :type value_cols: list, optional
+    :return: The sample table and the seconds taken.
+    :rtype: tuple(DataFrame, float)
+    """
+    time_start = perf_counter()
+    usecols = None if value_cols is None else [id_col] + list(value_cols)
+    df = read_df(file_path, usecols=usecols, **read_kwargs)
+    df = df.set_index(id_col)
+    if not df.index.is_unique:
+        print(f"{text_color(Path(file_path).name, 'yellow')}: "
+              f"{df.index.duplicated().sum()} duplicated {id_col}, "
+              f"first kept.")
+        df = df[~df.index.duplicated()]
+    return df, perf_counter() - time_start
+
+
+def load_samples(file_list,
+                 folder_path,
+                 id_col,
+                 value_cols=None,
+                 workers=4,
+                 processes=False,
+                 **read_kwargs):
+    """Read the sample files matching "file_list" (see
+    "search_target_files") in parallel and align them on "id_col" in a
+    single join. Columns are named "<file stem>", or "<file stem>_<column>"
+    if a file has more than one value column.
+
+    :param file_list: a list of files. (accept regular expression)
+    :type file_list: list
+    :param folder_path: The folder path to search for.
+    :type folder_path: Path
+    :param id_col: The probe ID column of every file.
+    :type id_col: str
+    :param value_cols: Columns to keep of each file, defaults to None (all
+        the others)
+    :type value_cols: list, optional
+    :param workers: Number of files read at a time, defaults to 4
+    :type workers: int, optional
+    :param processes: Use a process pool instead of threads, defaults to False
+    :type processes: bool, optional
+    :return: The probe x sample matrix (samples in file name order, probes
+        in order of first appearance) and the rows, columns and seconds of
+        each file.
+    :rtype: tuple(DataFrame, DataFrame)
+    """
+    files = []
+    for name in file_list:
+        files += sorted(search_target_files([name], folder_path))
+    if not files:
+        print(f"No file matching {text_color(file_list, 'red')} "
+              f"in {folder_path}")
+        sys.exit()
+    executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor_class(max_workers=workers) as executor:
+        futures = [executor.submit(load_sample, file, id_col, value_cols,
+                                   **read_kwargs) for file in files]
+        results = [future.result() for future in futures]
+
+    list_df, list_timing = [], []
+    for file, (df, seconds) in zip(files, results):
+        stem = Path(file).stem
+        if len(df.columns) == 1:
+            df.columns = [stem]
+        else:
+            df.columns = [f"{stem}_{col}" for col in df.columns]
+        list_df.append(df)
+        list_timing.append({"File": Path(file).name, "Rows": len(df),
+                            "Columns": len(df.columns), "Seconds": seconds})
+    df_matrix = pd.concat(list_df, axis=1, join="outer", sort=False)
+    return df_matrix, pd.DataFrame(list_timing)
+
+
+###====== Statistics ======###
+def p_adjust_bh(p_values):
+    """Benjamini-Hochberg adjusted p-values (q-values).
+
+    :param p_values: The p-values, missing values are kept as missing.
+    :type p_values: array-like
+    :return: The adjusted p-values, in the input order.
+    :rtype: ndarray
+    """
+    p_values = np.asarray(p_values, dtype=float)
+    q_values = np.full(p_values.shape, np.nan)
+    valid = ~np.isnan(p_values)
+    p = p_values[valid]
+    n = len(p)
+    if n == 0:
+        return q_values
+    order = np.argsort(p)[::-1]
+    q = p[order] * n / np.arange(n, 0, -1)
+    q = np.minimum.accumulate(q)
+    q_sorted = np.empty(n)
+    q_sorted[order] = np.minimum(q, 1)
+    q_values[valid] = q_sorted
+    return q_values
+
+
 ###====== Error messages ======###
 def error_config(message, message_highlight, check_highlight, config_file, exit=True):
     """Print error message for config error and whether to exit program or not.
@@ -262,6 +728,129 @@ def error_config(message, message_highlight, check_highlight, config_file, exit=
         sys.exit()
 
 
+###====== Profiling ======###
+class Profiler:
+    """Collect stage durations, call latencies, counters and peak memory of
+    a run, and write them as a JSON report. Safe to share across threads.
+
+    Usage:
+        profiler = Profiler()
+        with profiler.stage("read"):
+            df = read_df(input_file)
+        profiler.latency("datasets", seconds)
+        profiler.count("cache_hits", 10)
+        profiler.write_report(output_folder / "run_profile.json")
+
+    :param trace_memory: Trace the peak Python memory with "tracemalloc"
+        (slows down allocations), defaults to False
+    :type trace_memory: bool, optional
+    """
+    ## Upper bounds of the latency histogram, in milliseconds.
+    LATENCY_BINS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+    def __init__(self, trace_memory=False):
+        self.start = perf_counter()
+        self.stages = {}
+        self.latencies = {}
+        self.counters = {}
+        self.lock = Lock()
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name):
+        """Time the block as stage "name", repeated stages are summed."""
+        stage_start = perf_counter()
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - stage_start
+            with self.lock:
+                total, calls = self.stages.get(name, (0.0, 0))
+                self.stages[name] = (total + seconds, calls + 1)
+
+    def timed(self, name):
+        """Decorator, time every call of the function as stage "name"."""
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def latency(self, name, seconds):
+        """Record the latency of one call to "name"."""
+        with self.lock:
+            self.latencies.setdefault(name, []).append(seconds)
+
+    def count(self, name, n=1):
+        """Add "n" to counter "name"."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        """The run report.
+
+        :return: Wall time, stages, latency summaries and histograms,
+            counters, rows per second (with a "rows" counter) and peak memory
+        (from "resource", or "psutil" on Windows if installed).
+        :rtype: dict
+        """
+        wall = perf_counter() - self.start
+        report = {"wall_seconds": round(wall, 3),
+                  "stages": {name: {"seconds": round(total, 3), "calls": calls}
+                             for name, (total, calls) in self.stages.items()},
+                  "latency": {},
+                  "counters": dict(self.counters)}
+        for name, values in self.latencies.items():
+            ms = np.array(values) * 1000
+            edges = self.LATENCY_BINS + [np.inf]
+            counts = np.histogram(ms, bins=[0] + edges)[0]
+            report["latency"][name] = {
+                "calls": len(ms),
+                "mean_ms": round(float(ms.mean()), 1),
+                "p50_ms": round(float(np.percentile(ms, 50)), 1),
+                "p95_ms": round(float(np.percentile(ms, 95)), 1),
+                "max_ms": round(float(ms.max()), 1),
+                "histogram_ms": {f"<={edge}" if np.isfinite(edge) else
+                                 f">{self.LATENCY_BINS[-1]}": int(n)
+                                 for edge, n in zip(edges, counts)}}
+        if "rows" in self.counters and wall > 0:
+            report["rows_per_second"] = round(self.counters["rows"] / wall, 1)
+        if self.trace_memory and tracemalloc.is_tracing():
+            report["peak_traced_mb"] = round(
+                tracemalloc.get_traced_memory()[1] / 1024 ** 2, 1)
+        if resource is not None:
+            ## Kilobytes on Linux, bytes on macOS.
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            scale = 1024 ** 2 if sys.platform == "darwin" else 1024
+            report["peak_rss_mb"] = round(max_rss / scale, 1)
+        elif psutil is not None:
+            ## Peak working set in bytes on Windows.
+            memory = psutil.Process().memory_info()
+            peak = getattr(memory, "peak_wset", None)
+            if peak is not None:
+                report["peak_rss_mb"] = round(peak / 1024 ** 2, 1)
+        return report
+
+    def write_report(self, output_file, **info):
+        """Write the report as JSON, with "info" (ex: input file) on top.
+
+        :param output_file: Path to the JSON file.
+        :type output_file: Path
+        :return: The report.
+        :rtype: dict
+        """
+        report = {key: str(value) if isinstance(value, Path) else value
+                  for key, value in info.items()}
+        report.update(self.report())
+        with open(output_file, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        return report
+
+
 ###====== Utilities ======###
 ### Display time.
 def show_time(time_used, text="Time taken:", color="bright_cyan"):
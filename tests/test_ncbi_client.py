@@ -0,0 +1,114 @@
+"""
+Failure handling of "ncbi_client.DatasetsClient" against the fake
+"datasets" of "benchmarks/fake_ncbi.py". Run with "python -m pytest tests".
+"""
+import sys
+from pathlib import Path
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "scripts"))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+from ncbi_client import DatasetsClient, TRANSIENT_ERRORS
+from ncbi_data import lookup_genes
+from fake_ncbi import write_wrappers
+
+__author__ = "Johnathan Lin <jagonball@g-mail.nsysu.edu.tw>"
+__email__ = "jagonball@g-mail.nsysu.edu.tw"
+
+FIELDS = "symbol,gene-id,synonyms"
+
+
+@pytest.fixture
+def fake(tmp_path, monkeypatch):
+    """Path to the fake "datasets", failures set by "inject"."""
+    for name in ["FAKE_NCBI_FAIL", "FAKE_NCBI_FAIL_CALLS",
+                 "FAKE_NCBI_FAIL_GENES", "FAKE_NCBI_LATENCY"]:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("FAKE_NCBI_STATE", str(tmp_path / "calls.txt"))
+    return write_wrappers(tmp_path)
+
+
+def inject(monkeypatch, mode=None, calls=None, genes=None):
+    if mode is not None:
+        monkeypatch.setenv("FAKE_NCBI_FAIL", mode)
+    if calls is not None:
+        monkeypatch.setenv("FAKE_NCBI_FAIL_CALLS", str(calls))
+    if genes is not None:
+        monkeypatch.setenv("FAKE_NCBI_FAIL_GENES", ",".join(genes))
+
+
+def lookup(fake, genes, max_retries=3):
+    client = DatasetsClient(fake, max_rps=1000, max_retries=max_retries,
+                            backoff=0.001)
+    gene_results = lookup_genes(genes, "symbol", "human", FIELDS,
+                                batch_size=len(genes), client=client)
+    return gene_results, client
+
+
+@pytest.mark.parametrize("mode", ["429", "503", "truncate", "garbage"])
+def test_transient_failure_is_retried(fake, monkeypatch, mode):
+    inject(monkeypatch, mode, calls=2)
+    gene_results, client = lookup(fake, ["G1", "G2", "G10"])
+    assert client.retries == 2
+    assert client.failed == {}
+    assert len(gene_results["G1"]) == 1
+    assert gene_results["G10"].empty
+    assert client.not_found == {"G10"}
+
+
+def test_throttling_slows_down(fake, monkeypatch):
+    inject(monkeypatch, "429", calls=1)
+    _, client = lookup(fake, ["G1"])
+    ## Halved once, then raised by a tenth on success.
+    assert client.bucket.rate == pytest.approx(1000 * 0.6)
+
+
+def datasets_calls(client):
+    return len(client.profiler.latencies.get("datasets", []))
+
+
+@pytest.mark.parametrize("mode", ["503", "truncate", "garbage"])
+def test_retries_exhausted_are_reported(fake, monkeypatch, mode):
+    inject(monkeypatch, mode)
+    gene_results, client = lookup(fake, ["G1", "G2"], max_retries=1)
+    assert gene_results == {}
+    assert set(client.failed) == {"G1", "G2"}
+    df_failed = client.failed_report("symbol")
+    assert df_failed["symbol"].tolist() == ["G1", "G2"]
+
+
+def test_outage_does_not_split_the_batch(fake, monkeypatch):
+    inject(monkeypatch, "503")
+    genes = [f"G{k}" for k in range(1, 101)]
+    _, client = lookup(fake, genes, max_retries=2)
+    ## The batch and its 2 retries, no query of single genes.
+    assert datasets_calls(client) == 3
+    assert client.retries == 2
+    assert list(client.failed) == genes
+
+
+def test_exit_without_message_is_not_retried(fake, monkeypatch):
+    inject(monkeypatch, "exit")
+    gene_results, client = lookup(fake, ["G1"])
+    assert client.retries == 0
+    assert client.failed == {"G1": "datasets exited with 2"}
+
+
+def test_permanent_error_fails_only_its_gene(fake, monkeypatch):
+    inject(monkeypatch, genes=["ZNF500"])
+    gene_results, client = lookup(fake, ["G1", "ZNF500", "G3"])
+    assert client.retries == 0
+    ## The batch, then each gene alone.
+    assert datasets_calls(client) == 4
+    assert list(client.failed) == ["ZNF500"]
+    assert len(gene_results["G1"]) == 1 and len(gene_results["G3"]) == 1
+    assert "ZNF500" not in gene_results
+
+
+def test_transient_patterns():
+    assert TRANSIENT_ERRORS.search("Error: 503 Service Unavailable")
+    assert TRANSIENT_ERRORS.search("read: connection reset by peer")
+    assert TRANSIENT_ERRORS.search("Get https://api: unexpected EOF")
+    assert not TRANSIENT_ERRORS.search("Error: invalid identifier ZNF500")
+    assert not TRANSIENT_ERRORS.search("Error: no connection to gene GEOF1")
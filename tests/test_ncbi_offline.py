@@ -0,0 +1,78 @@
+"""
+"ncbi_offline.py" store built from small fixture dumps of the NCBI gene
+bulk files. Run with "python -m pytest tests".
+"""
+import sys
+from pathlib import Path
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "scripts"))
+from ncbi_offline import build_store, OfflineGeneStore
+from ncbi_data import annotate_genes
+
+__author__ = "Johnathan Lin <jagonball@g-mail.nsysu.edu.tw>"
+__email__ = "jagonball@g-mail.nsysu.edu.tw"
+
+GENE_INFO = """\
+#tax_id	GeneID	Symbol	Synonyms	description	type_of_gene
+9606	1	A1BG	A1B|ABG|GAB	alpha-1-B glycoprotein	protein-coding
+9606	2	GAB	-	GAB gene	protein-coding
+9606	3	A2M	-	alpha-2-macroglobulin	protein-coding
+10090	11	Gab	-	mouse gene	protein-coding
+"""
+GENE2GO = """\
+#tax_id	GeneID	GO_ID	GO_term	Category
+9606	1	GO:0000002	term 2	Process
+9606	1	GO:0000003	term 3	Process
+9606	2	GO:0000001	term 1	Process
+9606	3	GO:0000004	term 4	Function
+"""
+GENE2REFSEQ = """\
+#tax_id	GeneID	RNA_nucleotide_accession.version	protein_accession.version	orientation
+9606	1	NM_130786.4	NP_570602.2	-
+9606	2	NM_000001.1	NP_000001.1	+
+"""
+
+
+@pytest.fixture
+def store(tmp_path):
+    files = {}
+    for name, text in [("gene_info", GENE_INFO), ("gene2go", GENE2GO),
+                       ("gene2refseq", GENE2REFSEQ)]:
+        files[name] = tmp_path / f"{name}.txt"
+        files[name].write_text(text)
+    db_path = tmp_path / "store.sqlite"
+    build_store(files["gene_info"], files["gene2go"], db_path, "human",
+                files["gene2refseq"])
+    store = OfflineGeneStore(db_path)
+    yield store
+    store.close()
+
+
+def test_official_symbol_takes_precedence(store):
+    gene_results = store.lookup(["GAB", "abg", "A2M", "NONE"], "symbol")
+    assert gene_results["GAB"]["Symbol"].unique().tolist() == ["GAB"]
+    assert gene_results["abg"]["Symbol"].unique().tolist() == ["A1BG"]
+    assert gene_results["NONE"].empty
+    df_annot, *_ = annotate_genes(gene_results, "all",
+                                  {"NCBI GeneID": "Gene_ID"},
+                                  {"Gene Ontology Biological Process Go ID":
+                                   "GOBP_ID"}, verbose=False)
+    assert df_annot.loc["GAB", "Gene_ID"] == "2"
+    assert df_annot.loc["GAB", "GOBP_ID"] == "GO:0000001"
+    assert df_annot.loc["abg", "GOBP_ID"] == "GO:0000002;GO:0000003"
+
+
+def test_gene_table_layout(store):
+    df_gene = store.lookup(["A1BG"], "symbol")["A1BG"]
+    ## One row per GO term, synonyms joined as in "dataformat".
+    assert len(df_gene) == 2
+    assert df_gene["Synonyms"].unique().tolist() == ["A1B,ABG,GAB"]
+    assert df_gene["Orientation"].unique().tolist() == ["minus"]
+
+
+def test_gene_id_and_accession(store):
+    assert store.lookup(["3"], "gene-id")["3"]["Symbol"].iloc[0] == "A2M"
+    df_acc = store.lookup(["nm_130786"], "accession")["nm_130786"]
+    assert df_acc["Symbol"].unique().tolist() == ["A1BG"]
@@ -0,0 +1,27 @@
+"""
+Tests of "utilities.py". Run with "python -m pytest tests".
+"""
+import sys
+from pathlib import Path
+import pandas as pd
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "scripts"))
+from utilities import read_df
+
+__author__ = "Johnathan Lin <jagonball@g-mail.nsysu.edu.tw>"
+__email__ = "jagonball@g-mail.nsysu.edu.tw"
+
+
+def test_compact_chunks_with_empty_category_chunk(tmp_path):
+    ## Probes without a symbol grouped at the end of the array.
+    df = pd.DataFrame({"ProbeName": [f"P{i}" for i in range(40)],
+                       "symbol": ["A", "B"] * 10 + [None] * 20,
+                       "Sample_1": [float(i) for i in range(40)]})
+    input_file = tmp_path / "probes.txt"
+    df.to_csv(input_file, sep='\t', index=False)
+    df_read = read_df(input_file, compact=True, chunksize=10)
+    assert isinstance(df_read["symbol"].dtype, pd.CategoricalDtype)
+    assert sorted(df_read["symbol"].cat.categories) == ["A", "B"]
+    assert df_read["symbol"].isna().sum() == 20
+    assert df_read["symbol"].iloc[:20].tolist() == ["A", "B"] * 10